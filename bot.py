@@ -5,13 +5,15 @@ from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message,
 from pyrogram.enums import ParseMode
 from config import Config
 from database import db
-from downloader import downloader
+from downloader import downloader, ytdlp_format_choices
+from uploader import StreamingUpload, upload_file, send_uploaded_document, stop_media_sessions
 from helpers import (
     Progress, humanbytes, is_url, is_magnet, 
-    is_video_file, get_file_extension, sanitize_filename
+    is_video_file, get_file_extension, sanitize_filename, normalize_url, truncate_text
 )
 import time
 import random
+import math
 
 # Initialize bot
 app = Client(
@@ -29,6 +31,9 @@ user_cooldowns = {}
 # Cooldown settings
 COOLDOWN_TIME = 159  # 2 minutes 39 seconds
 
+# Torrent files per page of the picker keyboard
+TORRENT_PICKER_FILES = 20
+
 # Random emojis for reactions
 REACTION_EMOJIS = ["👍", "❤", "🔥", "🎉", "😍", "👏", "⚡", "✨", "💯", "🚀"]
 
@@ -57,6 +62,18 @@ def get_remaining_time(user_id):
     
     return int(remaining)
 
+def cooldown_text(user_id):
+    """The "You can send new task after" line for a user's cooldown"""
+    return f"You can send new task after **{format_time(get_remaining_time(user_id))}**"
+
+def default_caption(settings, name, size):
+    """The user's caption, or the bot's default one for a file"""
+    return settings.get('caption',
+        f"📁 **{name}**\n\n"
+        f"💾 **Size:** {humanbytes(size)}\n"
+        f"⚡ **Powered by:** {Config.DEVELOPER}"
+    )
+
 # Start command - Auto-filter style with random reaction and image
 @app.on_message(filters.command("start") & filters.private)
 async def start_command(client, message: Message):
@@ -170,16 +187,19 @@ async def settings_callback(client, callback: CallbackQuery):
 • Custom filename: {}
 • Custom caption: {}
 • Thumbnail: {}
+• Direct upload: {}
 
 **How to set:**
 📝 Send `/setname <filename>` - Set custom filename
 💬 Send `/setcaption <text>` - Set custom caption
 🖼️ Send a photo - Set as thumbnail
+⚡ Send `/directmode` - Upload while downloading
 🗑️ Send `/clearsettings` - Clear all settings
 👁️ Send `/showthumb` - View your thumbnail""".format(
         settings.get('filename', 'Not set'),
         'Set ✅' if settings.get('caption') else 'Not set',
-        'Set ✅' if settings.get('thumbnail') else 'Not set'
+        'Set ✅' if settings.get('thumbnail') else 'Not set',
+        'On ✅' if settings.get('direct') else 'Off'
     )
     
     keyboard = InlineKeyboardMarkup([
@@ -199,16 +219,19 @@ async def settings_command(client, message: Message):
 • Custom filename: {}
 • Custom caption: {}
 • Thumbnail: {}
+• Direct upload: {}
 
 **How to set:**
 📝 Send `/setname <filename>` - Set custom filename
 💬 Send `/setcaption <text>` - Set custom caption
 🖼️ Send a photo - Set as thumbnail
+⚡ Send `/directmode` - Upload while downloading
 🗑️ Send `/clearsettings` - Clear all settings
 👁️ Send `/showthumb` - View your thumbnail""".format(
         settings.get('filename', 'Not set'),
         'Set ✅' if settings.get('caption') else 'Not set',
-        'Set ✅' if settings.get('thumbnail') else 'Not set'
+        'Set ✅' if settings.get('thumbnail') else 'Not set',
+        'On ✅' if settings.get('direct') else 'Off'
     )
     
     keyboard = InlineKeyboardMarkup([
@@ -329,121 +352,20 @@ async def handle_upload_type(client, callback: CallbackQuery):
         filename = os.path.basename(filepath)
         filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
         
-        caption = settings.get('caption', 
-            f"📁 **{filename}**\n\n"
-            f"💾 **Size:** {humanbytes(filesize)}\n"
-            f"⚡ **Powered by:** {Config.DEVELOPER}"
-        )
+        caption = default_caption(settings, filename, filesize)
         
-        # Progress tracker
+        # Progress tracker - uploads are paced by the shared bandwidth scheduler
         progress = Progress(client, callback.message)
+        upload_progress = downloader.bandwidth.throttle_progress(progress.progress_callback, user_id)
         
-        if upload_type == 'doc':
-            # Upload as document
-            await client.send_document(
-                chat_id=callback.message.chat.id,
-                document=filepath,
-                caption=caption,
-                thumb=thumbnail,
-                progress=progress.progress_callback,
-                progress_args=("Uploading",)
-            )
-        else:  # original
-            # Auto-detect and upload in original format
-            ext = get_file_extension(filepath).lower()
-            image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']
-            
-            if ext in image_exts:
-                await client.send_photo(
-                    chat_id=callback.message.chat.id,
-                    photo=filepath,
-                    caption=caption,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-            elif is_video_file(filepath):
-                # Get video metadata
-                duration = width = height = 0
-                try:
-                    import subprocess
-                    result = subprocess.run(
-                        ['ffprobe', '-v', 'error', '-show_entries',
-                         'format=duration:stream=width,height', '-of',
-                         'default=noprint_wrappers=1', filepath],
-                        capture_output=True, text=True, timeout=10
-                    )
-                    for line in result.stdout.split('\n'):
-                        if 'duration=' in line:
-                            duration = int(float(line.split('=')[1]))
-                        elif 'width=' in line:
-                            width = int(line.split('=')[1])
-                        elif 'height=' in line:
-                            height = int(line.split('=')[1])
-                except:
-                    pass
-                
-                await client.send_video(
-                    chat_id=callback.message.chat.id,
-                    video=filepath,
-                    caption=caption,
-                    thumb=thumbnail,
-                    duration=duration,
-                    width=width,
-                    height=height,
-                    supports_streaming=True,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-            else:
-                # Fallback to document
-                await client.send_document(
-                    chat_id=callback.message.chat.id,
-                    document=filepath,
-                    caption=caption,
-                    thumb=thumbnail,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-        
-        await db.update_stats(user_id, upload=True)
-        await db.log_action(user_id, "upload", filepath)
-        
-        # Delete progress message
-        try:
-            await callback.message.delete()
-        except:
-            pass
-        
-        # Set cooldown after successful upload
-        user_cooldowns[user_id] = time.time()
-        
-        # Success message with cooldown
-        remaining = get_remaining_time(user_id)
-        time_str = format_time(remaining)
-        
-        success_msg = await client.send_message(
-            callback.message.chat.id,
-            f"✅ **Upload Complete!**\n\n"
-            f"⏳ You can send new task after **{time_str}**"
+        sent = await send_file(
+            client, callback.message.chat.id, filepath, upload_type, caption, thumbnail, upload_progress
         )
         
-        # Start cooldown refresh task
-        asyncio.create_task(cooldown_refresh_message(client, success_msg, user_id))
-        
-        # Log to channel
-        try:
-            upload_type_name = 'Original' if upload_type == 'original' else 'Document'
-            
-            await client.send_message(
-                Config.LOG_CHANNEL,
-                f"📤 **New Upload**\n\n"
-                f"👤 User: {callback.from_user.mention}\n"
-                f"📁 File: `{filename}`\n"
-                f"💾 Size: {humanbytes(filesize)}\n"
-                f"📊 Type: {upload_type_name}"
-            )
-        except:
-            pass
+        await finish_upload(
+            client, callback.message, callback.from_user, task['url'], filepath, sent, upload_type,
+            cacheable=task.get('cacheable', True) and not task.get('renamed') and not thumbnail
+        )
         
     except Exception as e:
         error_msg = str(e)
@@ -458,7 +380,159 @@ async def handle_upload_type(client, callback: CallbackQuery):
         if user_id in user_tasks:
             del user_tasks[user_id]
 
-async def cooldown_refresh_message(client, message, user_id):
+def video_metadata(filepath):
+    """(duration, width, height) of a video from ffprobe - zeros when unknown"""
+    duration = width = height = 0
+    try:
+        import subprocess
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries',
+             'format=duration:stream=width,height', '-of',
+             'default=noprint_wrappers=1', filepath],
+            capture_output=True, text=True, timeout=10
+        )
+        for line in result.stdout.split('\n'):
+            if 'duration=' in line:
+                duration = int(float(line.split('=')[1]))
+            elif 'width=' in line:
+                width = int(line.split('=')[1])
+            elif 'height=' in line:
+                height = int(line.split('=')[1])
+    except:
+        pass
+    return duration, width, height
+
+async def send_file(client, chat_id, filepath, upload_type, caption, thumbnail, progress):
+    """Send a downloaded file as a document or in its original format - returns the sent Message"""
+    ext = get_file_extension(filepath).lower()
+    image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']
+    is_video = upload_type != 'doc' and is_video_file(filepath)
+    
+    # Large files are uploaded part by part over several connections, then sent by reference
+    if os.path.getsize(filepath) >= Config.PARALLEL_UPLOAD_MIN_SIZE and (upload_type == 'doc' or ext not in image_exts):
+        input_file = await upload_file(client, filepath, progress)
+        return await send_uploaded_document(
+            client, chat_id, input_file, os.path.basename(filepath), caption, thumbnail,
+            video=video_metadata(filepath) if is_video else None
+        )
+    
+    if upload_type == 'doc':
+        # Upload as document
+        return await client.send_document(
+            chat_id=chat_id,
+            document=filepath,
+            caption=caption,
+            thumb=thumbnail,
+            progress=progress,
+            progress_args=("Uploading",)
+        )
+    else:  # original
+        # Auto-detect and upload in original format
+        if ext in image_exts:
+            return await client.send_photo(
+                chat_id=chat_id,
+                photo=filepath,
+                caption=caption,
+                progress=progress,
+                progress_args=("Uploading",)
+            )
+        elif is_video:
+            # Get video metadata
+            duration, width, height = video_metadata(filepath)
+            
+            return await client.send_video(
+                chat_id=chat_id,
+                video=filepath,
+                caption=caption,
+                thumb=thumbnail,
+                duration=duration,
+                width=width,
+                height=height,
+                supports_streaming=True,
+                progress=progress,
+                progress_args=("Uploading",)
+            )
+        else:
+            # Fallback to document
+            return await client.send_document(
+                chat_id=chat_id,
+                document=filepath,
+                caption=caption,
+                thumb=thumbnail,
+                progress=progress,
+                progress_args=("Uploading",)
+            )
+
+async def cache_upload(url, upload_type, filepath, sent, key=None):
+    """Store the file_id of an upload of url in the file cache - under `key` for sources that aren't URLs"""
+    media = (sent.video or sent.document or sent.photo) if sent else None
+    key = key or (normalize_url(url) if is_url(url) else None)
+    if not media or not key:
+        return
+    try:
+        content_hash = await downloader.content_hash(filepath)
+        await db.cache_file(
+            key, upload_type, media.file_id,
+            os.path.basename(filepath), os.path.getsize(filepath), content_hash
+        )
+    except Exception as e:
+        print(f"File cache error: {e}")
+
+async def purge_cached_upload(url, upload_type, entry):
+    """Forget a cached upload whose file_id stopped working - under its URL and every hash match"""
+    try:
+        if url:
+            await db.purge_file_cache(normalize_url(url), upload_type)
+        if entry.get('content_hash'):
+            await db.purge_file_cache(upload_type=upload_type, content_hash=entry['content_hash'])
+    except Exception as e:
+        print(f"File cache error: {e}")
+
+async def finish_upload(client, status_msg, user, url, filepath, sent, upload_type, cacheable=True):
+    """Record a finished upload, cache its file_id and start the user's cooldown"""
+    user_id = user.id
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+    
+    await db.update_stats(user_id, upload=True)
+    await db.log_action(user_id, "upload", filepath)
+    
+    # Remember the upload so repeat requests for this URL skip download and upload.
+    # Renamed files and custom thumbnails are personal, so they are not shared.
+    if cacheable:
+        await cache_upload(url, upload_type, filepath, sent)
+    
+    # Delete progress message
+    try:
+        await status_msg.delete()
+    except:
+        pass
+    
+    # Set cooldown after successful upload
+    await finish_task_cooldown(client, status_msg.chat.id, user_id)
+    
+    # Log to channel
+    try:
+        upload_type_name = 'Original' if upload_type == 'original' else 'Document'
+        
+        await client.send_message(
+            Config.LOG_CHANNEL,
+            f"📤 **New Upload**\n\n"
+            f"👤 User: {user.mention}\n"
+            f"📁 File: `{filename}`\n"
+            f"💾 Size: {humanbytes(filesize)}\n"
+            f"📊 Type: {upload_type_name}"
+        )
+    except:
+        pass
+
+async def finish_task_cooldown(client, chat_id, user_id, headline="✅ **Upload Complete!**"):
+    """Start the user's cooldown and post a message that counts it down"""
+    user_cooldowns[user_id] = time.time()
+    success_msg = await client.send_message(chat_id, f"{headline}\n\n⏳ {cooldown_text(user_id)}")
+    asyncio.create_task(cooldown_refresh_message(client, success_msg, user_id, headline))
+
+async def cooldown_refresh_message(client, message, user_id, headline="✅ **Upload Complete!**"):
     """Refresh the cooldown message every 10 seconds"""
     last_text = ""
     consecutive_errors = 0
@@ -472,7 +546,7 @@ async def cooldown_refresh_message(client, message, user_id):
                 # Cooldown finished
                 try:
                     await message.edit_text(
-                        "✅ **Upload Complete!**\n\n"
+                        f"{headline}\n\n"
                         "🚀 **You can send new task now!**"
                     )
                 except Exception:
@@ -480,11 +554,7 @@ async def cooldown_refresh_message(client, message, user_id):
                 break
             
             # Create new message text
-            time_str = format_time(remaining)
-            new_text = (
-                f"✅ **Upload Complete!**\n\n"
-                f"⏳ You can send new task after **{time_str}**"
-            )
+            new_text = f"{headline}\n\n⏳ {cooldown_text(user_id)}"
             
             # Only update if text changed
             if new_text != last_text:
@@ -534,20 +604,15 @@ async def handle_rename_callback(client, callback: CallbackQuery):
         # Skip rename, show upload options
         user_tasks[user_id]['waiting_rename'] = False
         
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📤 Upload as Original", callback_data="upload_original")],
-            [InlineKeyboardButton("📁 Upload as Document", callback_data="upload_doc")]
-        ])
-        
         await callback.message.edit_text(
             "**Choose upload type:**\n\n"
             "How do you want to upload this file?",
-            reply_markup=keyboard
+            reply_markup=upload_type_keyboard()
         )
         await callback.answer()
 
 # Handle text input (URL or rename)
-@app.on_message(filters.text & filters.private & ~filters.command(["start", "help", "about", "status", "settings", "setname", "setcaption", "clearsettings", "showthumb", "total", "broadcast", "cancel", "ping"]))
+@app.on_message(filters.text & filters.private & ~filters.command(["start", "help", "about", "status", "settings", "setname", "setcaption", "clearsettings", "showthumb", "directmode", "total", "broadcast", "purgecache", "cancel", "ping"]))
 async def handle_text_input(client, message: Message):
     user_id = message.from_user.id
     
@@ -556,26 +621,19 @@ async def handle_text_input(client, message: Message):
         new_name = sanitize_filename(message.text.strip())
         filepath = user_tasks[user_id]['filepath']
         
-        # Create new path with new name
-        new_path = os.path.join(os.path.dirname(filepath), new_name)
-        
         try:
             # Rename file
             if os.path.exists(filepath):
-                os.rename(filepath, new_path)
+                new_path = downloader.rename(filepath, new_name)
                 user_tasks[user_id]['filepath'] = new_path
                 user_tasks[user_id]['waiting_rename'] = False
+                user_tasks[user_id]['renamed'] = True
                 
                 # Show upload options
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📤 Upload as Original", callback_data="upload_original")],
-                    [InlineKeyboardButton("📁 Upload as Document", callback_data="upload_doc")]
-                ])
-                
                 await message.reply_text(
                     f"✅ **Renamed to:** `{new_name}`\n\n"
                     f"**Choose upload type:**",
-                    reply_markup=keyboard
+                    reply_markup=upload_type_keyboard()
                 )
             else:
                 await message.reply_text("❌ **Error:** File not found!")
@@ -591,13 +649,8 @@ async def handle_text_input(client, message: Message):
         return
     
     # Check cooldown
-    remaining = get_remaining_time(user_id)
-    if remaining > 0:
-        time_str = format_time(remaining)
-        await message.reply_text(
-            f"⏳ **Please wait!**\n\n"
-            f"You can send new task after **{time_str}**"
-        )
+    if get_remaining_time(user_id) > 0:
+        await message.reply_text(f"⏳ **Please wait!**\n\n{cooldown_text(user_id)}")
         return
     
     # Process as download
@@ -609,13 +662,8 @@ async def handle_document(client, message: Message):
     user_id = message.from_user.id
     
     # Check cooldown
-    remaining = get_remaining_time(user_id)
-    if remaining > 0:
-        time_str = format_time(remaining)
-        await message.reply_text(
-            f"⏳ **Please wait!**\n\n"
-            f"You can send new task after **{time_str}**"
-        )
+    if get_remaining_time(user_id) > 0:
+        await message.reply_text(f"⏳ **Please wait!**\n\n{cooldown_text(user_id)}")
         return
     
     # Check if it's a torrent file
@@ -628,26 +676,263 @@ async def handle_document(client, message: Message):
         except Exception as e:
             await status_msg.edit_text(f"❌ **Error downloading torrent:** {str(e)}")
 
+# Offer a previously uploaded copy of a link instead of downloading it again.
+# With `filepath` the file is already downloaded (a hash match) and stays
+# available for a normal upload until a cached send succeeds.
+async def offer_cached_upload(message: Message, url, cached, filepath=None, cacheable=True):
+    user_id = message.from_user.id
+    
+    user_tasks[user_id] = {
+        'filepath': filepath,
+        'url': url,
+        'cached': cached,
+        'cacheable': cacheable,
+        'message': message,
+        'waiting_rename': False
+    }
+    
+    entry = next(iter(cached.values()))
+    buttons = []
+    if 'original' in cached:
+        buttons.append([InlineKeyboardButton("⚡ Send as Original", callback_data="cached_original")])
+    if 'doc' in cached:
+        buttons.append([InlineKeyboardButton("⚡ Send as Document", callback_data="cached_doc")])
+    if filepath:
+        buttons.append([InlineKeyboardButton("✏️ Rename Now", callback_data="rename_now")])
+        buttons.append([InlineKeyboardButton("📤 Upload Normally", callback_data="rename_skip")])
+        note = "This file was uploaded before and can be sent instantly, or uploaded again."
+    else:
+        buttons.append([InlineKeyboardButton("🔄 Download Again", callback_data="cached_refresh")])
+        note = "This link was uploaded before and can be sent instantly."
+    
+    await message.reply_text(
+        f"⚡ **Found in cache!**\n\n"
+        f"📁 **File:** `{entry.get('file_name')}`\n"
+        f"💾 **Size:** {humanbytes(entry.get('file_size', 0))}\n\n"
+        f"{note}",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+def upload_type_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📤 Upload as Original", callback_data="upload_original")],
+        [InlineKeyboardButton("📁 Upload as Document", callback_data="upload_doc")]
+    ])
+
+# Handle cached upload selection
+@app.on_callback_query(filters.regex("^cached_"))
+async def handle_cached_upload(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    task = user_tasks.get(user_id)
+    
+    if not task or 'cached' not in task:
+        await callback.answer("⚠️ Task expired! Send URL again.", show_alert=True)
+        return
+    
+    choice = callback.data.split('_', 1)[1]  # original, doc or refresh
+    entry = task['cached'].get(choice)
+    
+    if not entry and task['filepath']:
+        # Already downloaded - no need to fetch it again
+        await callback.message.edit_text("**Choose upload type:**", reply_markup=upload_type_keyboard())
+        return
+    
+    if not entry:
+        del user_tasks[user_id]
+        try:
+            await callback.message.delete()
+        except:
+            pass
+        await process_download(client, task['message'], task['url'], skip_cache=True)
+        return
+    
+    settings = user_settings.get(user_id, {})
+    caption = default_caption(settings, entry.get('file_name'), entry.get('file_size', 0))
+    
+    try:
+        await client.send_cached_media(
+            chat_id=callback.message.chat.id,
+            file_id=entry['file_id'],
+            caption=caption
+        )
+    except Exception as e:
+        # The file_id is no longer usable - forget it and fetch the file again
+        print(f"Cached upload failed for user {user_id}: {e}")
+        await purge_cached_upload(task['url'], choice, entry)
+        if task['filepath']:
+            # The downloaded file is still here - upload it normally
+            del task['cached']
+            await callback.message.edit_text(
+                "⚠️ **Cached copy expired!**\n\n**Choose upload type:**",
+                reply_markup=upload_type_keyboard()
+            )
+            return
+        del user_tasks[user_id]
+        await callback.message.edit_text("⚠️ **Cached copy expired!**\n\nDownloading again...")
+        await process_download(client, task['message'], task['url'], skip_cache=True)
+        return
+    
+    del user_tasks[user_id]
+    if task['filepath']:
+        downloader.cleanup(task['filepath'])
+    await db.update_stats(user_id, upload=True)
+    await db.log_action(user_id, "upload_cached", task['url'])
+    
+    # A hash match came from another URL - point this URL at the same upload too
+    if is_url(task['url']):
+        try:
+            await db.cache_file(
+                normalize_url(task['url']), choice, entry['file_id'],
+                entry.get('file_name'), entry.get('file_size', 0), entry.get('content_hash')
+            )
+        except Exception as e:
+            print(f"File cache error: {e}")
+    
+    await callback.message.edit_text(
+        "✅ **Upload Complete!**\n\n"
+        "⚡ Sent instantly from cache."
+    )
+
+# Let the user pick a video quality before anything is downloaded
+async def offer_quality_choice(status_msg, message: Message, url, choices, skip_cache=False):
+    user_id = message.from_user.id
+    
+    user_tasks[user_id] = {
+        'filepath': None,
+        'url': url,
+        'formats': choices,
+        'skip_cache': skip_cache,
+        'message': message,
+        'waiting_rename': False
+    }
+    
+    buttons = [[InlineKeyboardButton(f"🏆 Best that fits ({choices[0]['label']})", callback_data="quality_0")]]
+    for index, choice in enumerate(choices[1:8], start=1):
+        buttons.append([InlineKeyboardButton(f"🎬 {choice['label']}", callback_data=f"quality_{index}")])
+    
+    await status_msg.edit_text(
+        f"🎞️ **Choose quality**\n\n"
+        f"Sizes are estimates. Formats over {humanbytes(Config.MAX_FILE_SIZE)} are not listed.",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# Handle quality selection
+@app.on_callback_query(filters.regex("^quality_"))
+async def handle_quality_choice(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    task = user_tasks.get(user_id)
+    
+    if not task or 'formats' not in task:
+        await callback.answer("⚠️ Task expired! Send URL again.", show_alert=True)
+        return
+    
+    index = int(callback.data.split('_', 1)[1])
+    if index >= len(task['formats']):
+        await callback.answer("⚠️ Unknown quality!", show_alert=True)
+        return
+    
+    del user_tasks[user_id]
+    try:
+        await callback.message.delete()
+    except:
+        pass
+    # The file cache is keyed by URL, so only the default pick is shared with the next user of the link
+    await process_download(
+        client, task['message'], task['url'],
+        skip_cache=task['skip_cache'], ytdlp_format=task['formats'][index]['spec'], cacheable=index == 0
+    )
+
+async def finish_direct_upload(client, message: Message, status_msg, url, filepath, stream, cacheable=True):
+    """Complete a streamed upload - returns False to fall back to the normal upload flow"""
+    user_id = message.from_user.id
+    settings = user_settings.get(user_id, {})
+    thumbnail = settings.get('thumbnail')
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    
+    caption = default_caption(settings, filename, filesize)
+    
+    try:
+        await status_msg.edit_text("⬆️ **Finishing upload to Telegram...**\n\nPlease wait...")
+        sent = await stream.send(status_msg.chat.id, filename, caption, thumbnail)
+    except Exception as e:
+        print(f"Direct upload failed for user {user_id}, falling back: {e}")
+        return False
+    
+    try:
+        await db.update_stats(user_id, download=True)
+        await db.log_action(user_id, "download", url)
+        await finish_upload(
+            client, status_msg, message.from_user, url, filepath, sent, 'doc',
+            cacheable=cacheable and not thumbnail
+        )
+    finally:
+        downloader.cleanup(filepath)
+    return True
+
 # Download processing function
-async def process_download(client, message: Message, url):
+async def process_download(client, message: Message, url, skip_cache=False, ytdlp_format=None, cacheable=True):
     user_id = message.from_user.id
     
     await db.add_user(user_id, message.from_user.username, message.from_user.first_name)
     
+    # A torrent still waiting in the file picker is dropped by the new task
+    pending = user_tasks.get(user_id)
+    if pending and pending.get('torrent'):
+        del user_tasks[user_id]
+        downloader.close_torrent(pending['torrent'])
+    
+    # Links uploaded before are re-sent by file_id without touching disk or network.
+    # A quality pick was already checked before the picker and may differ from the cached copy.
+    if not skip_cache and ytdlp_format is None and is_url(url):
+        cached = await db.get_cached_files(normalize_url(url))
+        if cached:
+            await offer_cached_upload(message, url, cached)
+            return
+    
     # Start download
     status_msg = await message.reply_text(
         "🔄 **Processing your request...**\n\n"
         "Starting download..."
     )
     
+    # Torrents with several files let the user choose which ones to fetch
+    if is_magnet(url) or (not is_url(url) and url.endswith('.torrent')):
+        await process_torrent(client, message, status_msg, url)
+        return
+    
+    # Videos with several qualities under the size limit let the user choose first
+    if ytdlp_format is None and is_url(url) and await downloader.is_ytdlp_url(url):
+        info, error = await downloader.probe_ytdlp(url)
+        if info and info.get('playlist'):
+            await process_playlist(client, message, status_msg, url, info)
+            return
+        choices = ytdlp_format_choices(info, Config.MAX_FILE_SIZE) if info else []
+        if len(choices) > 1:
+            await offer_quality_choice(status_msg, message, url, choices, skip_cache)
+            return
+    
+    # Direct mode uploads parts to Telegram while the file downloads
+    settings = user_settings.get(user_id, {})
+    stream = StreamingUpload(client, downloader.bandwidth, user_id) if settings.get('direct') and is_url(url) else None
+    
     try:
         # Download with progress
         progress = Progress(client, status_msg)
         filepath, error = await downloader.download(
             url, 
-            progress_callback=progress.progress_callback
+            progress_callback=progress.progress_callback,
+            user_id=user_id,
+            stream=stream,
+            ytdlp_format=ytdlp_format
         )
         
+        if stream and stream.started and not error:
+            if await finish_direct_upload(client, message, status_msg, url, filepath, stream, cacheable):
+                return
+        elif stream:
+            stream.abort()
+        
         if error:
             await status_msg.edit_text(
                 f"❌ **Download Failed!**\n\n"
@@ -659,10 +944,23 @@ async def process_download(client, message: Message, url):
         await db.update_stats(user_id, download=True)
         await db.log_action(user_id, "download", str(url) if isinstance(url, str) else "torrent")
         
+        # Mirrors of a file we already uploaded are re-sent by file_id instead of uploaded again
+        if not skip_cache and is_url(url):
+            content_hash = await downloader.content_hash(filepath)
+            cached = await db.get_cached_files_by_hash(content_hash) if content_hash else None
+            if cached:
+                try:
+                    await status_msg.delete()
+                except:
+                    pass
+                await offer_cached_upload(message, url, cached, filepath, cacheable)
+                return
+        
         # Store task
         user_tasks[user_id] = {
             'filepath': filepath,
             'url': url if isinstance(url, str) else 'torrent',
+            'cacheable': cacheable,  # False for a quality the user picked over the default
             'waiting_rename': False
         }
         
@@ -705,6 +1003,315 @@ async def process_download(client, message: Message, url):
         )
         await db.log_action(user_id, "error", str(e))
 
+# Download every item of a playlist and upload each one as soon as it is ready
+async def process_playlist(client, message: Message, status_msg, url, info):
+    user_id = message.from_user.id
+    settings = user_settings.get(user_id, {})
+    thumbnail = settings.get('thumbnail')
+    entries = info['entries']
+    
+    if not entries:
+        await status_msg.edit_text("❌ **Playlist is empty!**")
+        return
+    
+    items = [{'title': truncate_text(entry['title'], 40), 'status': '⏳ Queued'} for entry in entries]
+    slots = asyncio.Semaphore(Config.PLAYLIST_CONCURRENCY)
+    count = f"First {len(entries)} of {info['count']}" if info['count'] > len(entries) else f"{len(entries)}"
+    header = f"📃 **{truncate_text(info['title'], 60)}**\n📦 **Items:** {count}\n\n"
+    
+    def render():
+        return header + "\n".join(
+            f"{index}. {item['status']} — `{item['title']}`" for index, item in enumerate(items, start=1)
+        )
+    
+    async def refresh():
+        last_text = ""
+        while True:
+            text = render()
+            if text != last_text:
+                try:
+                    await status_msg.edit_text(text)
+                    last_text = text
+                except Exception:
+                    pass
+            await asyncio.sleep(5)
+    
+    async def run_item(index, entry):
+        item = items[index - 1]
+        item_url = entry['url'] if is_url(entry['url']) else None
+        
+        async def download_progress(current, total, status="Downloading"):
+            item['status'] = f"⬇️ {current * 100 // total}%" if total else f"⬇️ {humanbytes(current)}"
+        
+        async def upload_progress(current, total, status="Uploading"):
+            item['status'] = f"⬆️ {current * 100 // total}%" if total else "⬆️ Uploading"
+        
+        async with slots:
+            # Items uploaded before are re-sent from the file cache
+            cached = None
+            if item_url:
+                try:
+                    cached = (await db.get_cached_files(normalize_url(item_url))).get('original')
+                except Exception as e:
+                    print(f"File cache lookup failed for playlist item {index}: {e}")
+            if cached:
+                try:
+                    caption = default_caption(settings, cached.get('file_name'), cached.get('file_size', 0))
+                    await client.send_cached_media(message.chat.id, cached['file_id'], caption=caption)
+                    item['status'] = "⚡ Sent from cache"
+                    return True
+                except Exception as e:
+                    print(f"Cached playlist item failed for user {user_id}: {e}")
+                    await purge_cached_upload(item_url, 'original', cached)
+            
+            item['status'] = "⬇️ Starting"
+            filepath, error = await downloader.download(
+                item_url or url,
+                progress_callback=download_progress,
+                user_id=user_id,
+                playlist_item=None if item_url else index
+            )
+            if error:
+                item['status'] = "❌ Download failed"
+                print(f"Playlist item {index} failed for user {user_id}: {error}")
+                return False
+            
+            try:
+                item['status'] = "⬆️ Uploading"
+                caption = default_caption(settings, os.path.basename(filepath), os.path.getsize(filepath))
+                sent = await send_file(
+                    client, message.chat.id, filepath, 'original', caption, thumbnail,
+                    downloader.bandwidth.throttle_progress(upload_progress, user_id)
+                )
+                if item_url and not thumbnail:
+                    await cache_upload(item_url, 'original', filepath, sent)
+                item['status'] = "✅ Done"
+            except Exception as e:
+                item['status'] = "❌ Upload failed"
+                print(f"Playlist item {index} upload failed for user {user_id}: {e}")
+                return False
+            finally:
+                downloader.cleanup(filepath)
+            
+            # The item is uploaded - a stats error must not fail it
+            try:
+                await db.update_stats(user_id, upload=True)
+            except Exception as e:
+                print(f"Stats error for user {user_id}: {e}")
+            return True
+    
+    refresher = asyncio.create_task(refresh())
+    try:
+        # One item's unexpected error must not abort the others
+        results = await asyncio.gather(
+            *[run_item(index, entry) for index, entry in enumerate(entries, start=1)],
+            return_exceptions=True
+        )
+    finally:
+        refresher.cancel()
+    
+    for index, result in enumerate(results, start=1):
+        if isinstance(result, Exception):
+            items[index - 1]['status'] = "❌ Failed"
+            print(f"Playlist item {index} failed for user {user_id}: {result}")
+    done = sum(1 for ok in results if ok is True)
+    
+    try:
+        await db.update_stats(user_id, download=True)
+        await db.log_action(user_id, "playlist", url)
+    except Exception as e:
+        print(f"Stats error for user {user_id}: {e}")
+    
+    try:
+        await status_msg.edit_text(render())
+    except Exception:
+        pass
+    
+    # Set cooldown after the playlist finished
+    await finish_task_cooldown(
+        client, message.chat.id, user_id,
+        f"✅ **Playlist Complete!** {done}/{len(entries)} items uploaded."
+    )
+
+# Let the user pick which files of a torrent to fetch
+async def process_torrent(client, message: Message, status_msg, source):
+    user_id = message.from_user.id
+    progress = Progress(client, status_msg)
+    job, error = await downloader.open_torrent(source, progress.progress_callback)
+    if error:
+        await status_msg.edit_text(
+            f"❌ **Download Failed!**\n\n"
+            f"**Error:** {error}\n\n"
+            f"Please check the torrent and try again."
+        )
+        return
+    
+    if len(job.files) == 1:
+        await fetch_torrent_selection(client, message, status_msg, job, [0])
+        return
+    
+    user_tasks[user_id] = {
+        'filepath': None,
+        'url': 'torrent',
+        'torrent': job,
+        'selected': set(),
+        'page': 0,
+        'message': message,
+        'status_msg': status_msg,
+        'waiting_rename': False
+    }
+    await status_msg.edit_text(torrent_picker_text(user_tasks[user_id]), reply_markup=torrent_picker_keyboard(user_tasks[user_id]))
+
+def torrent_picker_pages(job):
+    return max(1, math.ceil(len(job.files) / TORRENT_PICKER_FILES))
+
+def torrent_picker_text(task):
+    job = task['torrent']
+    return (
+        f"🧲 **{truncate_text(job.name, 60)}**\n"
+        f"📦 **Files:** {len(job.files)} | **Selected:** {len(task['selected'])}\n"
+        f"📄 **Page:** {task['page'] + 1}/{torrent_picker_pages(job)}\n\n"
+        f"Pick the files to download. Files over {humanbytes(Config.MAX_FILE_SIZE)} are marked ⛔. "
+        f"**All** picks every file that fits, on every page."
+    )
+
+def torrent_picker_keyboard(task):
+    buttons = []
+    start = task['page'] * TORRENT_PICKER_FILES
+    for index, path, size in task['torrent'].files[start:start + TORRENT_PICKER_FILES]:
+        if size > Config.MAX_FILE_SIZE:
+            mark = "⛔"
+        else:
+            mark = "✅" if index in task['selected'] else "⬜"
+        label = f"{mark} {truncate_text(os.path.basename(path), 40)} ({humanbytes(size)})"
+        buttons.append([InlineKeyboardButton(label, callback_data=f"tfile_{index}")])
+    pages = torrent_picker_pages(task['torrent'])
+    if pages > 1:
+        buttons.append([
+            InlineKeyboardButton("◀️ Prev", callback_data=f"tfile_page_{(task['page'] - 1) % pages}"),
+            InlineKeyboardButton(f"{task['page'] + 1}/{pages}", callback_data=f"tfile_page_{task['page']}"),
+            InlineKeyboardButton("Next ▶️", callback_data=f"tfile_page_{(task['page'] + 1) % pages}")
+        ])
+    buttons.append([
+        InlineKeyboardButton("☑️ All", callback_data="tfile_all"),
+        InlineKeyboardButton("⬇️ Download", callback_data="tfile_go"),
+        InlineKeyboardButton("❌ Cancel", callback_data="tfile_cancel")
+    ])
+    return InlineKeyboardMarkup(buttons)
+
+# Handle torrent file selection
+@app.on_callback_query(filters.regex("^tfile_"))
+async def handle_torrent_choice(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    task = user_tasks.get(user_id)
+    
+    if not task or 'torrent' not in task:
+        await callback.answer("⚠️ Task expired! Send the torrent again.", show_alert=True)
+        return
+    
+    job = task['torrent']
+    choice = callback.data.split('_', 1)[1]
+    fits = [index for index, path, size in job.files if size <= Config.MAX_FILE_SIZE]
+    
+    if choice == 'cancel':
+        del user_tasks[user_id]
+        downloader.close_torrent(job)
+        await callback.message.edit_text("✅ **Torrent cancelled.**")
+        return
+    
+    if choice == 'go':
+        if not task['selected']:
+            await callback.answer("⚠️ Pick at least one file!", show_alert=True)
+            return
+        del user_tasks[user_id]
+        await callback.answer()
+        await fetch_torrent_selection(client, task['message'], task['status_msg'], job, sorted(task['selected']))
+        return
+    
+    if choice.startswith('page_'):
+        task['page'] = int(choice.split('_', 1)[1]) % torrent_picker_pages(job)
+    elif choice == 'all':
+        task['selected'] = set() if task['selected'] == set(fits) else set(fits)
+    else:
+        index = int(choice)
+        if index not in fits:
+            await callback.answer("⛔ This file is over the size limit!", show_alert=True)
+            return
+        task['selected'] ^= {index}
+    
+    await callback.answer()
+    try:
+        await callback.message.edit_text(torrent_picker_text(task), reply_markup=torrent_picker_keyboard(task))
+    except Exception:
+        pass  # Unchanged (same page pressed again)
+
+# Download the chosen torrent files and upload each one as soon as it completes
+async def fetch_torrent_selection(client, message: Message, status_msg, job, indices):
+    user_id = message.from_user.id
+    settings = user_settings.get(user_id, {})
+    thumbnail = settings.get('thumbnail')
+    uploaded = []
+    
+    async def paced(current, total, status="Uploading"):
+        pass
+    
+    async def upload(filepath):
+        try:
+            caption = default_caption(settings, os.path.basename(filepath), os.path.getsize(filepath))
+            
+            # Files uploaded before, from any link or torrent, are re-sent by file_id
+            content_hash = await downloader.content_hash(filepath)
+            cached = (await db.get_cached_files_by_hash(content_hash)).get('original') if content_hash else None
+            if cached:
+                try:
+                    await client.send_cached_media(message.chat.id, cached['file_id'], caption=caption)
+                    await db.update_stats(user_id, upload=True)
+                    uploaded.append(filepath)
+                    return
+                except Exception as e:
+                    print(f"Cached torrent file failed for user {user_id}: {e}")
+                    await purge_cached_upload(None, 'original', cached)
+            
+            sent = await send_file(
+                client, message.chat.id, filepath, 'original', caption, thumbnail,
+                downloader.bandwidth.throttle_progress(paced, user_id)
+            )
+            await db.update_stats(user_id, upload=True)
+            if not thumbnail:
+                await cache_upload(None, 'original', filepath, sent, key=f"torrent:{job.key}/{os.path.relpath(filepath, job.job_dir)}")
+            uploaded.append(filepath)
+        except Exception as e:
+            print(f"Torrent file upload failed for user {user_id}: {e}")
+    
+    try:
+        progress = Progress(client, status_msg)
+        paths, error = await downloader.fetch_torrent_files(job, indices, progress.progress_callback, on_file=upload)
+    finally:
+        # Files stay on disk until here - the session reads them while seeding
+        downloader.close_torrent(job)
+    
+    if error:
+        await status_msg.edit_text(
+            f"❌ **Download Failed!**\n\n"
+            f"**Error:** {error}\n\n"
+            f"Please check the torrent and try again."
+        )
+        return
+    
+    await db.update_stats(user_id, download=True)
+    await db.log_action(user_id, "download", "torrent")
+    
+    try:
+        await status_msg.delete()
+    except:
+        pass
+    
+    # Set cooldown after the torrent finished
+    await finish_task_cooldown(
+        client, message.chat.id, user_id,
+        f"✅ **Torrent Complete!** {len(uploaded)}/{len(indices)} files uploaded."
+    )
+
 # Settings commands
 @app.on_message(filters.command("setname") & filters.private)
 async def setname_command(client, message: Message):
@@ -740,6 +1347,23 @@ async def setcaption_command(client, message: Message):
     
     await message.reply_text("✅ **Caption set successfully!**")
 
+@app.on_message(filters.command("directmode") & filters.private)
+async def directmode_command(client, message: Message):
+    user_id = message.from_user.id
+    if user_id not in user_settings:
+        user_settings[user_id] = {}
+    direct = not user_settings[user_id].get('direct')
+    user_settings[user_id]['direct'] = direct
+    
+    if direct:
+        await message.reply_text(
+            "⚡ **Direct upload enabled!**\n\n"
+            "Direct links are uploaded as documents while they download, "
+            "skipping the rename and upload type steps."
+        )
+    else:
+        await message.reply_text("✅ **Direct upload disabled!**")
+
 @app.on_message(filters.command("clearsettings") & filters.private)
 async def clearsettings_command(client, message: Message):
     user_id = message.from_user.id
@@ -899,6 +1523,19 @@ async def broadcast_command(client, message: Message):
         f"📊 **Total:** {len(users)}"
     )
 
+# Purge file cache (owner only)
+@app.on_message(filters.command("purgecache") & filters.user(Config.OWNER_ID))
+async def purgecache_command(client, message: Message):
+    if len(message.command) > 1:
+        deleted = await db.purge_file_cache(normalize_url(message.command[1]))
+    else:
+        deleted = await db.purge_file_cache()
+    
+    await message.reply_text(
+        f"🗑️ **File cache purged!**\n\n"
+        f"• Entries removed: {deleted}"
+    )
+
 # Cancel command - Cancel current task
 @app.on_message(filters.command("cancel") & filters.private)
 async def cancel_command(client, message: Message):
@@ -911,6 +1548,8 @@ async def cancel_command(client, message: Message):
         # Clean up file
         if filepath:
             downloader.cleanup(filepath)
+        if task.get('torrent'):
+            downloader.close_torrent(task['torrent'])
         
         # Remove task
         del user_tasks[user_id]
@@ -951,6 +1590,13 @@ async def unknown_command(client, message: Message):
 # Startup message
 async def startup():
     """Send startup notification"""
+    await downloader.start()
+    
+    try:
+        await db.ensure_indexes()
+    except Exception as e:
+        print(f"Index creation failed: {e}")
+    
     try:
         await app.send_message(
             Config.OWNER_ID,
@@ -973,9 +1619,14 @@ async def shutdown():
         filepath = task.get('filepath')
         if filepath:
             downloader.cleanup(filepath)
+        if task.get('torrent'):
+            downloader.close_torrent(task['torrent'])
     
     user_tasks.clear()
     
+    await downloader.shutdown()
+    await stop_media_sessions()
+    
     try:
         await app.send_message(
             Config.OWNER_ID,
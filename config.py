@@ -30,14 +30,102 @@ class Config:
     # Download/Upload settings
     MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 4 GB
     SPEED_LIMIT = 500 * 1024 * 1024  # 500 MB/s (SUPER FAST!)
+    UPLOAD_RESERVED_SHARE = 0.2  # Slice of SPEED_LIMIT kept free for uploads while any upload runs
     CHUNK_SIZE = 2 * 1024 * 1024  # 2 MB chunks for maximum speed
+
+    # Segmented download settings
+    DOWNLOAD_CONNECTIONS = 8  # Parallel range requests per file
+    MIN_SEGMENT_SIZE = 16 * 1024 * 1024  # Don't split files into segments smaller than 16 MB
+    SEGMENT_RETRIES = 5  # Retries per segment before the download fails
+    WRITE_QUEUE_SIZE = 32  # Chunks buffered per download while the disk catches up
+    PREALLOCATE = True  # fallocate() the full file size before writing
+    HASH_BLOCK_SIZE = 4 * 1024 * 1024  # Content hash block - segments and resumes align to it
+
+    # Shared HTTP connection pool
+    HTTP_CONNECTIONS_LIMIT = 200  # Total open connections across all downloads
+    HTTP_CONNECTIONS_PER_HOST = 32  # Open connections to a single host
+
+    # yt-dlp worker processes
+    YTDLP_WORKERS = 4  # yt-dlp jobs running at once - the rest queue
+    YTDLP_TIMEOUT = 2 * 60 * 60  # Kill a yt-dlp job still running after 2 hours
+    YTDLP_INFO_TTL = 30 * 60  # Reuse extracted video metadata for 30 minutes
+    YTDLP_PREWARM = True  # Start the yt-dlp workers at bot startup instead of on the first link
+    PLAYLIST_MAX_ITEMS = 25  # Only the first 25 entries of a playlist are fetched
+    PLAYLIST_CONCURRENCY = 3  # Playlist items downloading at once per job
+    
+    # URL routing - a listed domain also covers its subdomains
+    YTDLP_DOMAINS = [
+        'youtube.com', 'youtu.be', 'instagram.com', 'facebook.com',
+        'twitter.com', 'tiktok.com', 'vimeo.com', 'dailymotion.com',
+        'x.com', 'twitch.tv', 'reddit.com', 'streamable.com', 'imgur.com'
+    ]  # Always handled by yt-dlp
+    HTTP_DOMAINS = []  # Always downloaded as plain files, even if yt-dlp has an extractor for them
+    
+    # Parallel uploads - large files are sent part by part over several connections
+    UPLOAD_CONNECTIONS = 4  # Extra MTProto media connections shared by all uploads
+    UPLOAD_WORKERS = 8  # Parts of one file in flight at once (each holds a 512 KB buffer)
+    PARALLEL_UPLOAD_MIN_SIZE = 20 * 1024 * 1024  # Smaller files go through Pyrogram's own upload
+    
+    # Direct mode - upload to Telegram while the download is still running
+    STREAM_UPLOAD_WORKERS = 4  # Parts uploaded concurrently (each buffers 512 KB)
+    
+    # Telegram file_id cache - repeat requests for a URL are re-sent without downloading
+    FILE_CACHE_TTL = 7 * 24 * 60 * 60  # 7 days
     
     # Download directory
     DOWNLOAD_DIR = "downloads"
+    PARTIAL_MAX_AGE = 24 * 60 * 60  # Keep resumable .part files for 24 hours
+    DISK_FREE_MARGIN = 512 * 1024 * 1024  # Never promise the last 512 MB of the download volume
+    DISK_WAIT_TIMEOUT = 30 * 60  # Give up after waiting 30 minutes for disk space
     
     # Torrent settings
     TORRENT_DOWNLOAD_PATH = "downloads/torrents"
     TORRENT_SEED_TIME = 0  # Don't seed after download
+    TORRENT_RESUME_INTERVAL = 60  # Save resume data of running torrents every minute
+    TORRENT_METADATA_TTL = 30 * 24 * 60 * 60  # Keep fetched torrent metadata for 30 days
+    TORRENT_WORKER_NICE = 5  # The torrent worker process runs at a lower CPU priority than the bot
+    TORRENT_WORKER_CPUS = []  # CPU cores the torrent worker is pinned to - empty for all
+    TORRENT_WORKER_MEMORY = 0  # Address space limit of the torrent worker in bytes - 0 for none
+    
+    # libtorrent settings profiles - compare them with `python torrent_benchmark.py`
+    TORRENT_PROFILE = "server"  # Profile the bot's session runs with
+    TORRENT_PROFILES = {
+        # libtorrent's defaults plus the old connection limit
+        'default': {
+            'connections_limit': 400
+        },
+        # Dedicated server - many disk threads, deep request queues, big buffers
+        'server': {
+            'connections_limit': 800,
+            'aio_threads': 16,
+            'hashing_threads': 4,
+            'file_pool_size': 200,
+            'max_queued_disk_bytes': 64 * 1024 * 1024,
+            'send_buffer_watermark': 8 * 1024 * 1024,
+            'send_buffer_low_watermark': 1024 * 1024,
+            'max_out_request_queue': 1500,
+            'max_allowed_in_request_queue': 2000,
+            'request_queue_time': 5,
+            'whole_pieces_threshold': 5,
+            'piece_extent_affinity': True,
+            'active_downloads': 16,
+            'active_limit': 64,
+            'storage_mode': 'sparse'
+        },
+        # Small VPS - libtorrent's min_memory_usage preset with fewer peers and threads
+        'low_memory': {
+            'preset': 'min_memory_usage',
+            'connections_limit': 100,
+            'aio_threads': 2,
+            'hashing_threads': 1,
+            'file_pool_size': 20,
+            'max_queued_disk_bytes': 4 * 1024 * 1024,
+            'max_out_request_queue': 250,
+            'active_downloads': 3,
+            'active_limit': 10,
+            'storage_mode': 'sparse'
+        }
+    }
     
     # Welcome message
     START_MESSAGE = """ʜᴇʏ {name}**, 
@@ -8,6 +8,14 @@ class Database:
         self.db = self.client['telegram_bot']
         self.users = self.db['users']
         self.logs = self.db['logs']
+        self.file_cache = self.db['file_cache']
+        
+    async def ensure_indexes(self):
+        """Create indexes - call once at startup"""
+        await self.file_cache.create_index([('url', 1), ('upload_type', 1)], unique=True)
+        await self.file_cache.create_index('content_hash', sparse=True)
+        # Mongo's TTL monitor evicts cache entries once they are older than FILE_CACHE_TTL
+        await self.file_cache.create_index('cached_at', expireAfterSeconds=Config.FILE_CACHE_TTL)
         
     async def add_user(self, user_id, username=None, first_name=None):
         """Add or update user in database"""
@@ -91,4 +99,45 @@ class Database:
             'total_uploads': 0
         }
 
+    async def get_cached_files(self, url):
+        """Get cached Telegram uploads for a normalized source URL, keyed by upload type"""
+        cursor = self.file_cache.find({'url': url})
+        entries = await cursor.to_list(length=None)
+        return {entry['upload_type']: entry for entry in entries}
+        
+    async def get_cached_files_by_hash(self, content_hash):
+        """Get cached Telegram uploads of identical content from any URL, keyed by upload type"""
+        cursor = self.file_cache.find({'content_hash': content_hash}).sort('cached_at', -1)
+        entries = await cursor.to_list(length=None)
+        cached = {}
+        for entry in entries:
+            cached.setdefault(entry['upload_type'], entry)
+        return cached
+        
+    async def cache_file(self, url, upload_type, file_id, file_name=None, file_size=0, content_hash=None):
+        """Remember the Telegram file_id an upload of url produced"""
+        await self.file_cache.update_one(
+            {'url': url, 'upload_type': upload_type},
+            {'$set': {
+                'file_id': file_id,
+                'file_name': file_name,
+                'file_size': file_size,
+                'content_hash': content_hash,
+                'cached_at': datetime.now()
+            }},
+            upsert=True
+        )
+        
+    async def purge_file_cache(self, url=None, upload_type=None, content_hash=None):
+        """Delete cached uploads - everything, or those matching a URL, upload type and/or content hash"""
+        query = {}
+        if url:
+            query['url'] = url
+        if content_hash:
+            query['content_hash'] = content_hash
+        if upload_type:
+            query['upload_type'] = upload_type
+        result = await self.file_cache.delete_many(query)
+        return result.deleted_count
+
 db = Database()
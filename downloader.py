@@ -1,301 +1,1518 @@
 import os
 import aiohttp
 import asyncio
-import yt_dlp
-import libtorrent as lt
 from config import Config
-from helpers import sanitize_filename
+from helpers import sanitize_filename, normalize_url, is_url, url_host, DomainIndex, merge_range, BandwidthScheduler, ContentHasher, hash_file
+from ytdlp_worker import YtdlpPool
+from media_formats import format_bytes, ytdlp_format_choices, ytdlp_fallback_format, parse_hls_master, parse_hls_media, parse_mpd, segments_size
+from torrent_worker import TorrentEngine, TorrentError
 import time
 import shutil
+import json
+import hashlib
+import queue
+import threading
+import uuid
+import itertools
+import collections
+import subprocess
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
 
-# Auxiliary function for formatting file sizes
-def format_bytes(size):
-    """Format bytes into human-readable string (e.g., 1.2 GB)"""
-    power = 2**10
-    n = 0
-    units = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
-    while size > power:
-        size /= power
-        n += 1
-    return f"{size:.2f} {units[n]}"
+ROUTE_TTL = 10 * 60  # Remember how a URL was routed for 10 minutes
+SIZE_SAMPLES = 3  # Segments sized with HEAD to estimate a stream without byte ranges or bitrate
+STREAM_RESERVE_STEP = 64 * 1024 * 1024  # Disk reserved at a time once a stream outgrows its estimate
+
+class DownloadError(Exception):
+    """Download failure that retrying the same request can't fix"""
+
+class PartialDownload:
+    """On-disk state of a ranged download: a `.part` file plus a JSON sidecar of completed ranges"""
+
+    def __init__(self, directory, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        self.url = url
+        self.part_path = os.path.join(directory, f"{key}.part")
+        self.meta_path = os.path.join(directory, f"{key}.json")
+        self.total_size = 0
+        self.etag = None
+        self.last_modified = None
+        self.completed = []  # Sorted, merged [start, end) byte ranges already on disk
+        self.hasher = ContentHasher(Config.HASH_BLOCK_SIZE)
+        self.last_save = 0
+
+    def load(self, total_size, etag=None, last_modified=None):
+        """Restore completed ranges if the remote file is unchanged, otherwise start a fresh .part file"""
+        self.total_size = total_size
+        self.etag = etag
+        self.last_modified = last_modified
+        
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            valid = (
+                meta.get('url') == self.url and
+                meta.get('total_size') == total_size and
+                meta.get('etag') == etag and
+                meta.get('last_modified') == last_modified and
+                os.path.getsize(self.part_path) == total_size
+            )
+        except (OSError, ValueError):
+            valid = False
+        
+        if valid:
+            self.completed = [list(r) for r in meta.get('completed', [])]
+            self.hasher = ContentHasher(Config.HASH_BLOCK_SIZE, meta.get('block_hashes'))
+            return True
+        
+        self.completed = []
+        self.hasher = ContentHasher(Config.HASH_BLOCK_SIZE)
+        with open(self.part_path, 'wb') as f:
+            f.truncate(total_size)
+        self.save()
+        return False
+
+    def if_range(self):
+        """Validator for the If-Range header, so a changed remote file is never mixed into the .part"""
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def completed_bytes(self):
+        return sum(end - start for start, end in self.completed)
+
+    def missing(self):
+        """Byte ranges [start, end) that still have to be fetched
+
+        Gaps are widened to whole hash blocks so every block is hashed from its
+        first byte - at most one block per gap edge is fetched again.
+        """
+        block = Config.HASH_BLOCK_SIZE
+        gaps = []
+        pos = 0
+        for start, end in self.completed + [[self.total_size, self.total_size]]:
+            if start > pos:
+                gap_start = pos - pos % block
+                gap_end = min(self.total_size, -(-start // block) * block)
+                if gaps and gap_start <= gaps[-1][1]:
+                    gaps[-1] = (gaps[-1][0], max(gaps[-1][1], gap_end))
+                else:
+                    gaps.append((gap_start, gap_end))
+            pos = max(pos, end)
+        return gaps
+
+    def mark(self, start, end):
+        """Record bytes [start, end) as written and checkpoint the sidecar every few seconds"""
+        self.completed = merge_range(self.completed, start, end)
+        
+        if time.time() - self.last_save >= 5:
+            self.save()
+
+    def save(self):
+        """Atomically write the sidecar"""
+        self.last_save = time.time()
+        meta = {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'total_size': self.total_size,
+            'completed': self.completed,
+            'block_hashes': dict(self.hasher.digests)
+        }
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def finish(self, filepath):
+        """Move the completed .part file into place and drop the sidecar"""
+        os.replace(self.part_path, filepath)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+    def discard(self):
+        """Forget any partial state for this URL"""
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+class FileWriter:
+    """Writes download chunks from a background thread so disk flushes never block the event loop
+
+    Chunks are handed over through a bounded queue: once
+    Config.WRITE_QUEUE_SIZE chunks are waiting, `write()` suspends the
+    producer until the disk catches up. An optional ContentHasher is fed
+    from the same thread.
+    """
+
+    def __init__(self, path, preallocate=0, truncate=False, on_written=None, hasher=None):
+        self.path = path
+        self.on_written = on_written
+        self.hasher = hasher
+        self._loop = asyncio.get_running_loop()
+        self._queue = queue.Queue()
+        self._slots = asyncio.Semaphore(Config.WRITE_QUEUE_SIZE)
+        self._closed = self._loop.create_future()
+        self._error = None
+        self._preallocate = preallocate if Config.PREALLOCATE else 0
+        self._file = open(path, 'wb' if truncate else 'r+b')
+        self._thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    async def write(self, data, offset=None):
+        """Queue data for writing at offset (or at the current position when offset is None)"""
+        if self._error:
+            raise self._error
+        await self._slots.acquire()
+        self._queue.put((offset, data))
+
+    async def close(self):
+        """Flush everything queued, close the file and re-raise any write error"""
+        self._queue.put(None)
+        await self._closed
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        try:
+            if self._preallocate:
+                self._allocate(self._preallocate)
+        except Exception as e:
+            self._error = e
+        
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            offset, data = item
+            try:
+                if self._error is None:
+                    if offset is not None:
+                        self._file.seek(offset)
+                    else:
+                        offset = self._file.tell()
+                    self._file.write(data)
+                    # Hash here too, so hashing costs neither a second read nor loop time
+                    if self.hasher:
+                        self.hasher.update(offset, data)
+                    if self.on_written:
+                        self._loop.call_soon_threadsafe(self.on_written, offset, offset + len(data))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._loop.call_soon_threadsafe(self._slots.release)
+        
+        try:
+            self._file.close()
+        except Exception as e:
+            self._error = self._error or e
+        self._loop.call_soon_threadsafe(self._closed.set_result, None)
+
+    def _allocate(self, size):
+        """Reserve the full file size up front so the filesystem can lay it out contiguously"""
+        fd = self._file.fileno()
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+
+class DiskReservation:
+    """Disk space promised to one download until its file is cleaned up"""
+
+    def __init__(self, admission, size):
+        self.admission = admission
+        self.size = size
+        self.paths = []  # Files/directories the download writes - their allocated blocks count as used
+
+    def allocated(self):
+        """Bytes the download has already allocated on disk (so free space already reflects them)"""
+        total = 0
+        for path in self.paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for name in files:
+                        total += self._blocks(os.path.join(root, name))
+            else:
+                total += self._blocks(path)
+        return total
+
+    def _blocks(self, path):
+        try:
+            return os.stat(path).st_blocks * 512
+        except (OSError, AttributeError):
+            return 0
+
+    def absorb(self, other):
+        """Take over another reservation's space - one job grew its download"""
+        self.size += other.size
+        other.size = 0
+        other.release()
+
+    def release(self):
+        self.admission.release(self)
+
+class DiskAdmission:
+    """Admission control for downloads against the free space of the download volume
+
+    Each job reserves its expected size before transferring. Jobs that don't
+    fit wait in FIFO order until earlier downloads are cleaned up, instead of
+    filling the disk and failing halfway.
+    """
+
+    def __init__(self, directory, margin, timeout):
+        self.directory = directory
+        self.margin = margin
+        self.timeout = timeout
+        self._reservations = []
+        self._lock = asyncio.Lock()  # FIFO - the oldest waiting job is admitted first
+        self._freed = None
+
+    def available(self):
+        """Free bytes not yet promised to running downloads"""
+        free = shutil.disk_usage(self.directory).free
+        pending = sum(max(0, r.size - r.allocated()) for r in self._reservations)
+        return free - pending - self.margin
+
+    def fits(self, size):
+        """Whether reserve(size) would be admitted right away, with no job waiting ahead of it"""
+        return not self._lock.locked() and self.available() >= size
+
+    async def reserve(self, size, progress_callback=None):
+        """Wait until size bytes can be promised to a download and return the reservation"""
+        if size > shutil.disk_usage(self.directory).total - self.margin:
+            raise DownloadError(f"File ({format_bytes(size)}) is larger than the download volume")
+        
+        if self._freed is None:
+            self._freed = asyncio.Event()
+        
+        async with self._lock:
+            deadline = time.time() + self.timeout
+            while self.available() < size:
+                if time.time() > deadline:
+                    raise DownloadError("Timed out waiting for free disk space")
+                if progress_callback:
+                    await progress_callback(0, size, "Waiting for disk space")
+                
+                # Woken by a release, or re-checked periodically in case space was freed elsewhere
+                self._freed.clear()
+                try:
+                    await asyncio.wait_for(self._freed.wait(), 5)
+                except asyncio.TimeoutError:
+                    pass
+            
+            reservation = DiskReservation(self, size)
+            self._reservations.append(reservation)
+            return reservation
+
+    def release(self, reservation):
+        if reservation in self._reservations:
+            self._reservations.remove(reservation)
+            if self._freed:
+                self._freed.set()
+
+class TorrentJob:
+    """A torrent in the torrent worker's session - see Downloader.open_torrent()"""
+    
+    def __init__(self, key, watch, job_dir):
+        self.key = key  # Infohash
+        self.watch = watch
+        self.job_dir = job_dir
+        self.name = None
+        self.total_size = 0
+        self.files = []  # (index, path inside job_dir, size)
+        self.reservation = None
+        self.resumed = False  # Added from resume data - pieces from the last run never raise file_completed
+        self.refs = 1  # Requests sharing this torrent - removed from the session with the last one
+        self.wanted = set()  # File indices any request has asked for
+        self.keep_files = False
+
+class DownloadFlight:
+    """One running download shared by every request for the same source
+
+    Besides progress it relays file events to streaming sinks (see
+    uploader.StreamingUpload) that consume the file while it downloads.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.consumers = 0
+        self.callbacks = []
+        self.sinks = []
+
+    def start_stream(self, path, total_size, filename):
+        """The target file exists and its final size is known"""
+        for sink in self.sinks:
+            try:
+                sink.start(path, total_size, filename)
+            except Exception as e:
+                print(f"Stream start error: {e}")
+
+    def stream_written(self, start, end):
+        """Bytes [start, end) of the target file are on disk"""
+        for sink in self.sinks:
+            if sink.started:
+                sink.written(start, end)
+
+    async def progress(self, current, total, status):
+        """Fan progress out to every attached consumer - each keeps its own throttling"""
+        for callback in list(self.callbacks):
+            try:
+                await callback(current, total, status)
+            except Exception as e:
+                print(f"Progress callback error: {e}")
 
 class Downloader:
     def __init__(self):
         self.download_dir = Config.DOWNLOAD_DIR
         self.torrent_dir = Config.TORRENT_DOWNLOAD_PATH
+        self.partial_dir = os.path.join(self.download_dir, '.partial')
+        self.jobs_dir = os.path.join(self.download_dir, 'jobs')
+        self._session = None
+        self._inflight = {}  # (source, filename) -> DownloadFlight
+        self._torrent_jobs = {}  # infohash -> TorrentJob shared by every request for that torrent
+        self._refs = {}  # filepath -> number of consumers still using it
+        self._hashes = {}  # filepath -> content hash
+        self._reservations = {}  # filepath -> DiskReservation, released by cleanup()
+        self.disk = DiskAdmission(self.download_dir, Config.DISK_FREE_MARGIN, Config.DISK_WAIT_TIMEOUT)
+        self.bandwidth = BandwidthScheduler(Config.SPEED_LIMIT, Config.UPLOAD_RESERVED_SHARE)
+        self.ytdlp = YtdlpPool(Config.YTDLP_WORKERS, Config.YTDLP_TIMEOUT, self.bandwidth)
+        self._ytdlp_info = {}  # normalized url -> (expires_at, metadata)
+        self.ytdlp_domains = DomainIndex(Config.YTDLP_DOMAINS)
+        self.http_domains = DomainIndex(Config.HTTP_DOMAINS)
+        self._unmatched_hosts = {}  # host -> expires_at, for hosts where no yt-dlp extractor matched
+        self._routes = {}  # normalized url -> (expires_at, handled by yt-dlp)
+        self._warmup = None
+        self._closing = False
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
+        if not os.path.exists(self.partial_dir):
+            os.makedirs(self.partial_dir)
+        if not os.path.exists(self.jobs_dir):
+            os.makedirs(self.jobs_dir)
         if not os.path.exists(self.torrent_dir):
             os.makedirs(self.torrent_dir)
+        self.torrents = TorrentEngine(self.torrent_dir)  # Worker process owning the libtorrent session
 
-    async def download_file(self, url, filename=None, progress_callback=None):
-        """Download file from URL using aiohttp with maximum speed - preserves original quality"""
+    async def start(self):
+        """Create long-lived resources - call once the event loop is running"""
+        self.purge_stale_partials()
         try:
+            resumable = await self.torrents.start()
+        except TorrentError as e:
+            print(f"Torrent worker failed to start: {e}")
+            resumable = None
+        self.purge_orphan_jobs(resumable)
+        await self.get_session()
+        if Config.YTDLP_PREWARM:
+            # Runs in the background - the bot doesn't wait for the workers
+            self._warmup = asyncio.create_task(self.ytdlp.warm(self._ytdlp_probe_options()))
+
+    async def shutdown(self):
+        """Release long-lived resources on bot shutdown"""
+        # Torrents still running are kept on disk and resumed when their link comes back
+        self._closing = True
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._warmup and not self._warmup.done():
+            self._warmup.cancel()
+        self.ytdlp.shutdown()
+        await self.torrents.stop()
+
+    def purge_stale_partials(self):
+        """Delete resumable .part files nobody has touched within Config.PARTIAL_MAX_AGE"""
+        cutoff = time.time() - Config.PARTIAL_MAX_AGE
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def purge_orphan_jobs(self, resumable=None):
+        """Delete job directories left behind by a previous run
+
+        Only torrents the worker can resume (`resumable` save paths) survive a
+        restart; with None the torrent directories are left alone.
+        """
+        roots = [self.jobs_dir] if resumable is None else [self.jobs_dir, self.torrent_dir]
+        resumable = set(resumable or [])
+        for root in roots:
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if len(name) == 12 and os.path.isdir(path) and os.path.abspath(path) not in resumable:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def new_job_dir(self, root=None):
+        """Create a private working directory for one job, so concurrent jobs never share file names"""
+        path = os.path.join(root or self.jobs_dir, uuid.uuid4().hex[:12])
+        os.makedirs(path)
+        return path
+
+    def _job_dir_of(self, path):
+        """The job directory a downloaded path lives in, if any"""
+        for root in (self.jobs_dir, self.torrent_dir):
+            rel = os.path.relpath(path, root)
+            if rel != os.curdir and not rel.startswith(os.pardir):
+                return os.path.join(root, rel.split(os.sep)[0])
+        return None
+
+    async def get_session(self):
+        """Get the process-wide HTTP session so DNS, keep-alive and TLS sessions are reused between jobs"""
+        if self._session is None or self._session.closed:
             timeout = aiohttp.ClientTimeout(total=None, connect=30, sock_read=30)
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
                 'Accept': '*/*',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Range': 'bytes=0-'
+                'Accept-Encoding': 'identity',
+                'Connection': 'keep-alive'
             }
             connector = aiohttp.TCPConnector(
-                limit=100,
-                limit_per_host=30,
+                limit=Config.HTTP_CONNECTIONS_LIMIT,
+                limit_per_host=Config.HTTP_CONNECTIONS_PER_HOST,
                 ttl_dns_cache=300,
                 force_close=False,
                 enable_cleanup_closed=True
             )
-            
-            async with aiohttp.ClientSession(
-                timeout=timeout, 
+            self._session = aiohttp.ClientSession(
+                timeout=timeout,
                 headers=headers,
                 connector=connector
-            ) as session:
-                async with session.get(url, allow_redirects=True) as response:
-                    if response.status not in (200, 206):
-                        return None, f"Failed to download: HTTP {response.status}"
-                    
-                    total_size = int(response.headers.get('content-length', 0))
-                    
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, "File size exceeds 4GB limit"
-                    
-                    if not filename:
-                        content_disp = response.headers.get('content-disposition', '')
-                        if 'filename=' in content_disp:
-                            filename = content_disp.split('filename=')[1].strip('"\'')
-                        else:
-                            filename = url.split('/')[-1].split('?')[0] or 'downloaded_file'
-                    
-                    filename = sanitize_filename(filename)
-                    filepath = os.path.join(self.download_dir, filename)
-                    
-                    downloaded = 0
-                    start_time = time.time()
-                    last_update = 0
-                    chunk_size = 10 * 1024 * 1024
-                    
-                    with open(filepath, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(chunk_size):
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            current_time = time.time()
-                            if progress_callback and (current_time - last_update) >= 1:
-                                last_update = current_time
-                                speed = downloaded / (current_time - start_time) / (1024 * 1024)
-                                await progress_callback(downloaded, total_size, f"Downloading ({speed:.1f} MB/s)")
-                    
+            )
+        return self._session
+
+    async def download_file(self, url, filename=None, progress_callback=None, user_id=None, stream=None, job_dir=None):
+        """Download file from URL using aiohttp with maximum speed - preserves original quality
+
+        Servers that support byte ranges are fetched over several parallel
+        connections into a resumable `.part` file, everything else falls back
+        to a single stream. `stream` (a DownloadFlight) is told about every
+        byte range as it reaches disk.
+        """
+        partial = PartialDownload(self.partial_dir, url)
+        job_dir = job_dir or self.new_job_dir()
+        filepath = None
+        reservation = None
+        try:
+            session = await self.get_session()
+            
+            # Probe with a one byte range to learn the size and range support
+            async with session.get(url, allow_redirects=True, headers={'Range': 'bytes=0-0'}) as response:
+                if response.status not in (200, 206):
+                    return None, f"Failed to download: HTTP {response.status}"
+                
+                total_size, supports_ranges = self._parse_probe(response)
+                
+                if total_size > Config.MAX_FILE_SIZE:
+                    return None, "File size exceeds 4GB limit"
+                
+                if not filename:
+                    content_disp = response.headers.get('content-disposition', '')
+                    if 'filename=' in content_disp:
+                        filename = content_disp.split('filename=')[1].strip('"\'')
+                    else:
+                        filename = url.split('/')[-1].split('?')[0] or 'downloaded_file'
+                
+                filename = sanitize_filename(filename)
+                filepath = os.path.join(job_dir, filename)
+                final_url = str(response.url)
+                etag = response.headers.get('etag')
+                last_modified = response.headers.get('last-modified')
+                
+                # Server ignored the range header - the probe is the whole file. It is
+                # streamed only if the disk can take it now; a job that has to wait for
+                # space lets the idle connection go and asks again once admitted.
+                if response.status == 200 and (not total_size or self.disk.fits(total_size)):
+                    partial.discard()
+                    reservation = await self._reserve(total_size, [partial.part_path, filepath], progress_callback)
+                    progress = self._progress_reporter(total_size, progress_callback, user_id=user_id)
+                    await self._download_single(response, partial, filename, total_size, progress, stream)
+                    self._complete(partial, filepath, reservation)
                     return filepath, None
-                    
+            
+            reservation = await self._reserve(total_size, [partial.part_path, filepath], progress_callback)
+            
+            if supports_ranges:
+                if partial.load(total_size, etag, last_modified):
+                    print(f"Resuming {url} from {format_bytes(partial.completed_bytes())}")
+                progress = self._progress_reporter(total_size, progress_callback, partial.completed_bytes(), user_id)
+                try:
+                    await self._download_segmented(session, final_url, partial, filename, progress, stream)
+                except DownloadError:
+                    partial.discard()
+                    raise
+                except BaseException:
+                    partial.save()
+                    raise
+            else:
+                partial.discard()
+                progress = self._progress_reporter(total_size, progress_callback, user_id=user_id)
+                async with session.get(final_url) as response:
+                    if response.status != 200:
+                        return None, f"Failed to download: HTTP {response.status}"
+                    await self._download_single(response, partial, filename, total_size, progress, stream)
+            
+            self._complete(partial, filepath, reservation)
+            return filepath, None
+                
         except asyncio.TimeoutError:
             return None, "Download timeout - server too slow"
         except aiohttp.ClientError as e:
             return None, f"Network error: {str(e)}"
         except Exception as e:
             return None, f"Download error: {str(e)}"
+        finally:
+            # Successful downloads hand the reservation over to cleanup()
+            if reservation and self._reservations.get(filepath) is not reservation:
+                reservation.release()
 
-    async def download_ytdlp(self, url, progress_callback=None):
-        """Download using yt-dlp with BEST quality - ORIGINAL file + TikTok support"""
+    async def _reserve(self, size, paths, progress_callback=None):
+        """Reserve disk space for a download of known size - unknown sizes can't be planned for"""
+        if not size:
+            return None
+        reservation = await self.disk.reserve(size, progress_callback)
+        reservation.paths = paths
+        return reservation
+
+    def _keep_reservation(self, filepath, reservation):
+        """Hold a finished download's reservation until cleanup() removes the file"""
+        previous = self._reservations.pop(filepath, None)
+        if previous and previous is not reservation:
+            previous.release()
+        if reservation:
+            reservation.paths = [filepath]
+            self._reservations[filepath] = reservation
+
+    def _complete(self, partial, filepath, reservation=None):
+        """Move a finished .part file into place and keep the content hash computed while downloading"""
+        digest = partial.hasher.hexdigest(os.path.getsize(partial.part_path))
+        partial.finish(filepath)
+        self._keep_reservation(filepath, reservation)
+        if digest:
+            self._hashes[filepath] = digest
+        else:
+            self._hashes.pop(filepath, None)
+
+    def _parse_probe(self, response):
+        """Return (total_size, supports_ranges) from a `Range: bytes=0-0` probe response"""
+        if response.status == 206:
+            # Content-Range: bytes 0-0/12345
+            total = response.headers.get('content-range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) > 0:
+                return int(total), True
+            return 0, False
+        
+        return int(response.headers.get('content-length', 0)), False
+
+    def _progress_reporter(self, total_size, progress_callback, already_downloaded=0, user_id=None):
+        """Build a shared, throttled progress counter for all connections of one download
+
+        Every chunk is also charged to the bandwidth scheduler, which paces the
+        connections to the user's fair share of Config.SPEED_LIMIT.
+        """
+        state = {'downloaded': already_downloaded, 'last_update': 0, 'start_time': time.time()}
+        
+        async def report(nbytes):
+            await self.bandwidth.acquire(nbytes, user_id)
+            state['downloaded'] += nbytes
+            current_time = time.time()
+            if progress_callback and (current_time - state['last_update']) >= 1:
+                state['last_update'] = current_time
+                speed = (state['downloaded'] - already_downloaded) / (current_time - state['start_time']) / (1024 * 1024)
+                await progress_callback(state['downloaded'], total_size, f"Downloading ({speed:.1f} MB/s)")
+        
+        return report
+
+    async def _download_single(self, response, partial, filename, total_size, progress, stream=None):
+        """Stream a whole response body into the .part file over one connection"""
+        writer = FileWriter(
+            partial.part_path,
+            preallocate=total_size,
+            truncate=True,
+            on_written=stream.stream_written if stream else None,
+            hasher=partial.hasher
+        )
+        if stream and total_size:
+            stream.start_stream(partial.part_path, total_size, filename)
         try:
-            ydl_opts = {
-                'outtmpl': os.path.join(self.download_dir, '%(title)s.%(ext)s'),
-                'format': 'bestvideo+bestaudio/best',
-                'merge_output_format': 'mp4',
-                'quiet': True,
-                'no_warnings': True,
-                'writethumbnail': False,
-                'no_post_overwrites': True,
-                'concurrent_fragment_downloads': 5,
-                'buffer_size': 16384,
-                'http_chunk_size': 10485760,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                    'Accept-Language': 'en-us,en;q=0.5',
-                    'Sec-Fetch-Mode': 'navigate',
-                    'Referer': 'https://www.tiktok.com/'
-                },
-                'extractor_args': {
-                    'tiktok': {
-                        'api_hostname': 'api22-normal-c-useast2a.tiktokv.com',
-                        'app_version': '34.1.2',
-                        'manifest_app_version': '341'
-                    }
-                },
-                'retries': 15,
-                'fragment_retries': 15,
-                'skip_unavailable_fragments': True,
-                'keepvideo': False,
-                'socket_timeout': 30,
-                'source_address': '0.0.0.0',
-                'postprocessor_args': {
-                    'ffmpeg': ['-threads', '4']
+            async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                await writer.write(chunk)
+                await progress(len(chunk))
+        finally:
+            await writer.close()
+
+    async def _download_segmented(self, session, url, partial, filename, progress, stream=None):
+        """Split the missing byte ranges of a .part file into segments and fetch them concurrently"""
+        missing = partial.missing()
+        remaining = sum(end - start for start, end in missing)
+        segment_size = max(Config.MIN_SEGMENT_SIZE, -(-remaining // Config.DOWNLOAD_CONNECTIONS))
+        # Keep segment boundaries on hash blocks so each block is hashed by one connection in order
+        segment_size = -(-segment_size // Config.HASH_BLOCK_SIZE) * Config.HASH_BLOCK_SIZE
+        ranges = [
+            (seg_start, min(seg_start + segment_size, end) - 1)
+            for start, end in missing
+            for seg_start in range(start, end, segment_size)
+        ]
+        
+        slots = asyncio.Semaphore(Config.DOWNLOAD_CONNECTIONS)
+        
+        def written(start, end):
+            partial.mark(start, end)
+            if stream:
+                stream.stream_written(start, end)
+        
+        # Ranges are marked complete only once the writer thread has them on disk
+        writer = FileWriter(
+            partial.part_path,
+            preallocate=partial.total_size,
+            on_written=written,
+            hasher=partial.hasher
+        )
+        
+        if stream:
+            stream.start_stream(partial.part_path, partial.total_size, filename)
+            for start, end in partial.completed:
+                stream.stream_written(start, end)
+        
+        validator = partial.if_range()
+        
+        async def fetch(start, end):
+            async def write(data, pos):
+                await writer.write(data, start + pos)
+            
+            async with slots:
+                # A 200 means the validator no longer matches - the .part file is stale
+                await self._fetch_segment(session, url, (start, end), write, progress, validator, restart=False)
+        
+        tasks = [asyncio.create_task(fetch(start, end)) for start, end in ranges]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await writer.close()
+
+    async def _fetch_segment(self, session, url, byte_range, write, progress, if_range=None, restart=True):
+        """Fetch one segment of a file, resuming it with a Range request after connection errors
+
+        `byte_range` is (first, last) inclusive, or None for the whole body.
+        `write(data, pos)` receives the segment's bytes at their offset within
+        the segment. Returns the segment's length. A 200 answer to a Range
+        request starts the segment over, cut out of the full body - or, without
+        `restart`, means the file changed. `if_range` is sent along as If-Range.
+        """
+        first, last = byte_range or (0, None)
+        pos = 0
+        reported = 0  # Bytes passed to progress - a restart fetches them again without counting them twice
+        attempts = 0
+        
+        while True:
+            headers = {}
+            if byte_range or pos:
+                headers['Range'] = f"bytes={first + pos}-{'' if last is None else last}"
+                if if_range:
+                    headers['If-Range'] = if_range
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status not in (200, 206):
+                        raise aiohttp.ClientError(f"HTTP {response.status} for {url} from byte {first + pos}")
+                    
+                    skip = 0
+                    if response.status == 200 and headers:
+                        if not restart:
+                            raise DownloadError("Remote file changed during download")
+                        # Range ignored - start over and cut the segment out of the full body
+                        pos, skip = 0, first
+                    
+                    async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                        if skip:
+                            cut = min(skip, len(chunk))
+                            chunk, skip = chunk[cut:], skip - cut
+                        if last is not None:
+                            chunk = chunk[:last - first + 1 - pos]
+                        if chunk:
+                            await write(chunk, pos)
+                            pos += len(chunk)
+                            attempts = 0
+                            if pos > reported:
+                                await progress(pos - reported)
+                                reported = pos
+                        if last is not None and first + pos > last:
+                            break
+                
+                if last is None or first + pos > last:
+                    return pos
+                raise aiohttp.ClientPayloadError(f"Connection closed at byte {first + pos} of {url}")
+                
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                attempts += 1
+                if attempts > Config.SEGMENT_RETRIES:
+                    raise
+                await asyncio.sleep(min(2 ** attempts, 30))
+
+    async def _fetch_bytes(self, session, url, byte_range=None, progress=None):
+        """Fetch a manifest or segment into memory"""
+        buffer = bytearray()
+        
+        async def collect(data, pos):
+            buffer[pos:pos + len(data)] = data
+        
+        async def ignore(nbytes):
+            pass
+        
+        size = await self._fetch_segment(session, url, byte_range, collect, progress or ignore)
+        del buffer[size:]
+        return buffer
+
+    async def _download_segments(self, session, segments, path, progress):
+        """Fetch media segments concurrently and write them to path in playback order
+
+        Up to twice Config.DOWNLOAD_CONNECTIONS segments are in flight or
+        waiting in memory for their turn, so a slow segment never stalls the
+        other connections for long and memory stays bounded.
+        """
+        writer = FileWriter(path, truncate=True)
+        
+        if len(segments) == 1:
+            # A single file - stream it straight to disk
+            url, byte_range = segments[0]
+            try:
+                await self._fetch_segment(session, url, byte_range, writer.write, progress)
+            finally:
+                await writer.close()
+            return
+        
+        slots = asyncio.Semaphore(Config.DOWNLOAD_CONNECTIONS)
+        window = Config.DOWNLOAD_CONNECTIONS * 2
+        queued = iter(segments)
+        pending = collections.deque()
+        
+        async def fetch(url, byte_range):
+            async with slots:
+                return await self._fetch_bytes(session, url, byte_range, progress)
+        
+        def refill():
+            for url, byte_range in itertools.islice(queued, window - len(pending)):
+                pending.append(asyncio.create_task(fetch(url, byte_range)))
+        
+        refill()
+        try:
+            while pending:
+                data = await pending.popleft()
+                refill()
+                await writer.write(data)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await writer.close()
+
+    async def _remux(self, inputs, output):
+        """Stream-copy downloaded tracks into one MP4 - False if ffmpeg is missing or fails"""
+        args = ['ffmpeg', '-y', '-v', 'error']
+        for path in inputs:
+            args += ['-i', path]
+        for index in range(len(inputs)):
+            args += ['-map', str(index)]
+        args += ['-c', 'copy', '-movflags', '+faststart', output]
+        
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+        except FileNotFoundError:
+            return False
+        
+        try:
+            _, stderr = await process.communicate()
+        except BaseException:
+            process.kill()
+            raise
+        
+        if process.returncode != 0:
+            print(f"ffmpeg remux failed: {stderr.decode(errors='replace')[-300:]}")
+            return False
+        return True
+
+    async def _estimate_size(self, session, segments):
+        """Bytes of a segment list - exact from byte ranges, else extrapolated from HEAD of a few segments (0 if unknown)"""
+        size = segments_size(segments)
+        if size is not None:
+            return size
+        
+        sample = segments[::max(1, len(segments) // SIZE_SAMPLES)][:SIZE_SAMPLES]
+        sizes = []
+        for url, byte_range in sample:
+            if byte_range:
+                sizes.append(byte_range[1] - byte_range[0] + 1)
+                continue
+            try:
+                async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                    length = int(response.headers.get('content-length', 0)) if response.status == 200 else 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                length = 0
+            if not length:
+                return 0
+            sizes.append(length)
+        return int(sum(sizes) / len(sizes) * len(segments))
+
+    async def _plan_hls(self, session, url, text):
+        """Pick the tracks of an HLS stream - returns (tracks, estimated size, container) or None for yt-dlp"""
+        if '#EXT-X-STREAM-INF' not in text:
+            media = parse_hls_media(text, url)
+            if media is None:
+                return None
+            segments, _ = media
+            size = await self._estimate_size(session, segments)
+            if size > Config.MAX_FILE_SIZE:
+                raise DownloadError(f"Stream ({format_bytes(size)}) is larger than {format_bytes(Config.MAX_FILE_SIZE)}")
+            return [segments], size, 'mp4' if '#EXT-X-MAP' in text else 'ts'
+        
+        variants = parse_hls_master(text, url)
+        for variant in variants:
+            playlist = (await self._fetch_bytes(session, variant['url'])).decode('utf-8', 'replace')
+            media = parse_hls_media(playlist, variant['url'])
+            if media is None:
+                return None
+            segments, duration = media
+            
+            # BANDWIDTH is the peak rate of the variant including its audio
+            size = int(variant['bandwidth'] / 8 * duration)
+            if size > Config.MAX_FILE_SIZE:
+                continue
+            
+            container = 'mp4' if '#EXT-X-MAP' in playlist else 'ts'
+            tracks = [segments]
+            if variant['audio_url']:
+                playlist = (await self._fetch_bytes(session, variant['audio_url'])).decode('utf-8', 'replace')
+                audio = parse_hls_media(playlist, variant['audio_url'])
+                if audio is None:
+                    return None
+                tracks.append(audio[0])
+            
+            return tracks, size, container
+        
+        raise DownloadError(f"Stream is larger than {format_bytes(Config.MAX_FILE_SIZE)} in every available quality")
+
+    async def _plan_dash(self, session, url, text):
+        """Pick the tracks of a DASH stream - returns (tracks, estimated size, container) or None for yt-dlp"""
+        parsed = parse_mpd(text, url)
+        if parsed is None:
+            return None
+        representations, duration = parsed
+        
+        audio = max((r for r in representations if r['type'] == 'audio'), key=lambda r: r['bandwidth'], default=None)
+        videos = sorted((r for r in representations if r['type'] == 'video'), key=lambda r: r['bandwidth'], reverse=True)
+        
+        async def track_size(representation):
+            if duration:
+                return int(representation['bandwidth'] / 8 * duration)
+            # No duration to weigh the bitrate with - size the track from its segments
+            return await self._estimate_size(session, representation['segments'])
+        
+        audio_size = await track_size(audio) if audio else 0
+        for video in videos:
+            size = await track_size(video) + audio_size
+            if size <= Config.MAX_FILE_SIZE:
+                return [video['segments']] + ([audio['segments']] if audio else []), size, 'mp4'
+        
+        if not videos and audio and audio_size <= Config.MAX_FILE_SIZE:
+            return [audio['segments']], audio_size, 'mp4'
+        raise DownloadError(f"Stream is larger than {format_bytes(Config.MAX_FILE_SIZE)} in every available quality")
+
+    async def download_manifest(self, url, filename=None, progress_callback=None, user_id=None, job_dir=None):
+        """Download an HLS (.m3u8) or DASH (.mpd) stream natively
+
+        The best quality that fits Config.MAX_FILE_SIZE is chosen, its segments
+        are fetched concurrently over the shared connection pool, and the
+        tracks are stream-copied into one MP4. Live, encrypted and other
+        streams this can't handle are passed on to yt-dlp.
+        """
+        job_dir = job_dir or self.new_job_dir()
+        reservation = None
+        tracks = []
+        try:
+            session = await self.get_session()
+            text = (await self._fetch_bytes(session, url)).decode('utf-8', 'replace')
+            
+            if text.lstrip().startswith('#EXTM3U'):
+                plan = await self._plan_hls(session, url, text)
+            elif '<MPD' in text[:4096]:
+                plan = await self._plan_dash(session, url, text)
+            else:
+                return None, "Not an HLS or DASH manifest"
+            
+            if plan is None:
+                print(f"Passing {url} to yt-dlp - not a static unencrypted stream")
+                return await self.download_ytdlp(url, progress_callback, user_id, job_dir)
+            segments_by_track, size, container = plan
+            
+            reservation = await self._reserve(size, [job_dir], progress_callback)
+            report = self._progress_reporter(size, progress_callback, user_id=user_id)
+            received = 0
+            
+            async def progress(nbytes):
+                # Estimates can be low or missing - the size limit and the disk
+                # reservation follow the bytes actually fetched
+                nonlocal reservation, received
+                received += nbytes
+                if received > Config.MAX_FILE_SIZE:
+                    raise DownloadError(f"Stream is larger than {format_bytes(Config.MAX_FILE_SIZE)}")
+                if received > (reservation.size if reservation else 0):
+                    extra = await self._reserve(STREAM_RESERVE_STEP, [job_dir], progress_callback)
+                    if reservation:
+                        reservation.absorb(extra)
+                    else:
+                        reservation = extra
+                await report(nbytes)
+            
+            for index, segments in enumerate(segments_by_track):
+                path = os.path.join(job_dir, f".track{index}.{container}")
+                await self._download_segments(session, segments, path, progress)
+                tracks.append(path)
+            
+            if not filename:
+                stem = os.path.splitext(os.path.basename(urlsplit(url).path))[0]
+                filename = f"{stem or 'video'}.mp4"
+            filepath = os.path.join(job_dir, sanitize_filename(filename))
+            
+            if not await self._remux(tracks, filepath):
+                if len(tracks) > 1:
+                    return None, "ffmpeg is required to merge the audio and video tracks"
+                # Without ffmpeg the single track is kept in its own container
+                filepath = f"{os.path.splitext(filepath)[0]}.{container}"
+                os.replace(tracks[0], filepath)
+            
+            self._keep_reservation(filepath, reservation)
+            reservation = None
+            return filepath, None
+            
+        except DownloadError as e:
+            return None, str(e)
+        except ET.ParseError as e:
+            return None, f"Invalid DASH manifest: {str(e)}"
+        except Exception as e:
+            return None, f"Download error: {str(e)}"
+        finally:
+            for path in tracks:
+                if os.path.exists(path):
+                    os.remove(path)
+            if reservation:
+                reservation.release()
+
+    def _ytdlp_options(self):
+        """Base yt-dlp options shared by metadata extraction and downloads"""
+        return {
+            'merge_output_format': 'mp4',
+            'quiet': True,
+            'no_warnings': True,
+            'writethumbnail': False,
+            'no_post_overwrites': True,
+            'concurrent_fragment_downloads': 5,
+            'buffer_size': 16384,
+            'http_chunk_size': 10485760,
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-us,en;q=0.5',
+                'Sec-Fetch-Mode': 'navigate',
+                'Referer': 'https://www.tiktok.com/'
+            },
+            'extractor_args': {
+                'tiktok': {
+                    'api_hostname': 'api22-normal-c-useast2a.tiktokv.com',
+                    'app_version': '34.1.2',
+                    'manifest_app_version': '341'
                 }
+            },
+            'retries': 15,
+            'fragment_retries': 15,
+            'skip_unavailable_fragments': True,
+            'keepvideo': False,
+            'socket_timeout': 30,
+            'source_address': '0.0.0.0',
+            'postprocessor_args': {
+                'ffmpeg': ['-threads', '4']
             }
+        }
+
+    def _ytdlp_probe_options(self):
+        """Options for metadata extraction - playlists are listed, not resolved entry by entry"""
+        opts = self._ytdlp_options()
+        opts.update({
+            'extract_flat': 'in_playlist',
+            'playlistend': Config.PLAYLIST_MAX_ITEMS
+        })
+        return opts
+
+    async def probe_ytdlp(self, url):
+        """Extract a video's metadata without downloading it - cached for Config.YTDLP_INFO_TTL"""
+        key = normalize_url(url)
+        now = time.time()
+        cached = self._ytdlp_info.get(key)
+        if cached and cached[0] > now:
+            return cached[1], None
+        
+        info, error = await self.ytdlp.probe(url, self._ytdlp_probe_options())
+        if error:
+            return None, error
+        
+        for stale in [k for k, (expires, _) in self._ytdlp_info.items() if expires <= now]:
+            del self._ytdlp_info[stale]
+        self._ytdlp_info[key] = (now + Config.YTDLP_INFO_TTL, info)
+        return info, None
+
+    async def download_ytdlp(self, url, progress_callback=None, user_id=None, job_dir=None, format_spec=None, playlist_item=None):
+        """Download using yt-dlp - the best format that fits Config.MAX_FILE_SIZE unless `format_spec` picks one
+
+        `playlist_item` downloads only that (1-based) entry of a playlist URL.
+        """
+        job_dir = job_dir or self.new_job_dir()
+        reservation = None
+        try:
+            info, error = await self.probe_ytdlp(url)
+            if error:
+                return None, error
             
-            loop = asyncio.get_event_loop()
+            choices = ytdlp_format_choices(info, Config.MAX_FILE_SIZE)
+            if format_spec:
+                size = next((c['size'] for c in choices if c['spec'] == format_spec), 0)
+            elif choices:
+                format_spec, size = choices[0]['spec'], choices[0]['size']
+            else:
+                # Audio-only, or formats without height/codec - pick by size alone
+                format_spec, size = ytdlp_fallback_format(info, Config.MAX_FILE_SIZE)
+                if format_spec is None:
+                    return None, f"Media is larger than {format_bytes(Config.MAX_FILE_SIZE)} in every available format"
             
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    filename = ydl.prepare_filename(info)
-                    
-                    base = os.path.splitext(filename)[0]
-                    possible_files = [f"{base}.mp4", f"{base}.mkv", f"{base}.webm", filename]
-                    
-                    for pfile in possible_files:
-                        if os.path.exists(pfile):
-                            return pfile, info.get('title', 'Video')
-                    
-                    return filename, info.get('title', 'Video')
+            reservation = await self._reserve(size, [job_dir], progress_callback)
+            
+            ydl_opts = self._ytdlp_options()
+            ydl_opts.update({
+                # Fragments and merge inputs stay in a temp folder; only the finished file lands in the job dir
+                'paths': {'home': job_dir, 'temp': os.path.join(job_dir, '.incomplete')},
+                'outtmpl': '%(title)s.%(ext)s',
+                'format': format_spec
+            })
+            if playlist_item:
+                ydl_opts['playlist_items'] = str(playlist_item)
             
-            filepath, title = await loop.run_in_executor(None, download)
+            result, error = await self.ytdlp.run(url, ydl_opts, user_id, progress_callback)
+            if error:
+                return None, error
+            filepath, title, digest = result
             
             if os.path.exists(filepath):
+                if digest:
+                    self._hashes[filepath] = digest
+                self._keep_reservation(filepath, reservation)
+                reservation = None
                 return filepath, None
             else:
                 return None, "Failed to download video - file not found after download"
                 
-        except yt_dlp.utils.DownloadError as e:
-            return None, f"yt-dlp download error: {str(e)}"
         except Exception as e:
             return None, f"Download error: {str(e)}"
+        finally:
+            if reservation:
+                reservation.release()
 
-    async def download_torrent(self, magnet_or_file, progress_callback=None):
-        """Download torrent using libtorrent with optimized and corrected settings"""
-        ses = None
-        handle = None
-        try:
-            # 1. Setup Session
-            ses = lt.session({'listen_interfaces': '0.0.0.0:6881'})
-            ses.add_dht_router('router.bittorrent.com', 6881)
-            ses.add_dht_router('router.utorrent.com', 6881)
-            
-            settings = {
-                'connections_limit': 400,
-                'alert_mask': lt.alert.category_t.error_notification | lt.alert.category_t.storage_notification | lt.alert.category_t.status_notification
-            }
-            ses.apply_settings(settings)
+    async def open_torrent(self, magnet_or_file, progress_callback=None, job_dir=None):
+        """Add a torrent to the torrent worker's session and wait for its metadata
 
-            # 2. Setup Add Parameters based on input type (FIXED API MISMATCH)
-            if magnet_or_file.startswith('magnet:'):
-                # FIX: Call parse_magnet_uri with ONE argument to get the new params object
-                p = lt.parse_magnet_uri(magnet_or_file) 
+        Nothing but metadata is fetched until `fetch_torrent_files()` picks the
+        files to download. Returns (TorrentJob, None) or (None, error); a job
+        must be released with `close_torrent()`.
+        """
+        if not magnet_or_file.startswith('magnet:') and not os.path.exists(magnet_or_file):
+            return None, "Torrent file not found"
+        
+        job_dir = job_dir or self.new_job_dir(self.torrent_dir)
+        job = None
+        try:
+            # The worker picks up resume data or cached metadata for this infohash on its own
+            added = await self.torrents.call('add', magnet_or_file, job_dir)
+            if added['existing'] and added['key'] not in self._torrent_jobs:
+                # Its last request closed it while we were adding - the removal is queued ahead of this retry
+                added = await self.torrents.call('add', magnet_or_file, job_dir)
+            if added['save_path'] != job_dir:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                job_dir = added['save_path']
+            job = self._torrent_jobs.get(added['key'])
+            if job:
+                # Another request has this torrent open - share its transfer and files
+                print(f"Joining open torrent {added['key']}")
+                job.refs += 1
             else:
-                # It's a torrent file path
-                if not os.path.exists(magnet_or_file):
-                    return None, "Torrent file not found"
-                p = lt.add_torrent_params()
-                p.ti = lt.torrent_info(magnet_or_file)
-            
-            # Apply common settings (save_path, storage_mode, flags)
-            p.save_path = self.torrent_dir
-            p.storage_mode = lt.storage_mode_t.storage_mode_sparse
-            p.flags = lt.torrent_flags.auto_managed 
-
-            # 3. Add Torrent
-            handle = ses.add_torrent(p)
+                job = TorrentJob(added['key'], self.torrents.watch(added['key'], added['status']), job_dir)
+                job.resumed = added['resumed']
+                self._torrent_jobs[job.key] = job
             
-            # 4. Wait for Metadata and Download Loop
+            # Wait for Metadata
             metadata_timeout = 180  # 3 minutes for metadata/connection
-            download_timeout = 7200 # 2 hours overall download timeout
             start_time = time.time()
-            last_progress = -1
             
-            while not handle.is_seed():
-                # Check overall timeout
+            while not job.watch.status.has_metadata:
+                job.watch.check()
+                if time.time() - start_time > metadata_timeout:
+                    raise DownloadError("Timeout waiting for torrent metadata (3 min)")
+                
+                # Update status message with connected peers
+                s = job.watch.status
+                if progress_callback:
+                    await progress_callback(0, 100, f"Connecting... ({s.num_peers} peers, {s.num_incomplete} seeds)")
+                await job.watch.changed(timeout=5)
+            
+            info = await self.torrents.call('files', job.key)
+            job.name = info['name']
+            job.total_size = info['total_size']
+            job.files = info['files']
+            return job, None
+            
+        except Exception as e:
+            if job:
+                self.close_torrent(job)
+            else:
+                shutil.rmtree(job_dir, ignore_errors=True)
+            if isinstance(e, (DownloadError, TorrentError)):
+                return None, str(e)
+            return None, f"Torrent error: {str(e)}"
+
+    async def fetch_torrent_files(self, job, indices, progress_callback=None, on_file=None):
+        """Download the chosen files of an opened torrent
+
+        Only files some request has chosen get a non-zero priority. `on_file(path)`
+        is started for each file as soon as libtorrent reports it complete, while
+        the rest keep downloading. Returns (paths, None) or (None, error).
+        """
+        indices = sorted(set(indices))
+        download_timeout = 7200  # 2 hours overall download timeout
+        start_time = time.time()
+        last_progress = -1
+        tasks = []
+        try:
+            for index in indices:
+                if job.files[index][2] > Config.MAX_FILE_SIZE:
+                    return None, f"{os.path.basename(job.files[index][1])} ({format_bytes(job.files[index][2])}) exceeds limit."
+            
+            # Hold the transfer until the chosen files fit on disk - files another
+            # request already asked for are covered by its reservation
+            added = [index for index in indices if index not in job.wanted]
+            reservation = await self._reserve(sum(job.files[index][2] for index in added), [job.job_dir], progress_callback)
+            job.wanted.update(added)
+            if reservation and job.reservation:
+                job.reservation.absorb(reservation)
+            elif reservation:
+                job.reservation = reservation
+            
+            priorities = [0] * len(job.files)
+            for index in job.wanted:
+                priorities[index] = 4
+            await self.torrents.call('prioritize', job.key, priorities)
+            
+            pending = set(indices)
+            paths = {}
+            
+            while pending:
                 if time.time() - start_time > download_timeout:
                     return None, "Torrent download timed out after 2 hours."
                 
-                s = handle.status()
-
-                # --- Alert Processing ---
-                alerts = ses.pop_alerts()
-                for alert in alerts:
-                    # Check for critical errors
-                    if type(alert) == lt.torrent_error_alert:
-                        return None, f"Torrent error: {alert.msg}"
-                    # Check for metadata errors/timeouts
-                    if type(alert) == lt.metadata_failed_alert:
-                        return None, "Failed to fetch metadata (no peers/dead torrent)"
+                await job.watch.changed(timeout=5)
+                job.watch.check()
                 
-                # --- Progress Reporting ---
-                if not handle.has_metadata():
-                    # Metadata phase
-                    elapsed = time.time() - start_time
-                    if elapsed > metadata_timeout:
-                        return None, "Timeout waiting for torrent metadata (3 min)"
-
-                    # Update status message with connected peers
-                    status_msg = f"Connecting... ({s.num_peers} peers, {s.num_incomplete} seeds)"
-                    if progress_callback:
-                        await progress_callback(0, 100, status_msg)
+                s = job.watch.status
+                done = [index for index in job.watch.completed_files if index in pending]
+                if job.resumed or (s.total_wanted and s.total_wanted_done == s.total_wanted):
+                    # Files finished before a restart, or file_completed alerts were missed - ask for the byte counts
+                    file_progress = await self.torrents.call('file_progress', job.key)
+                    done += [index for index in pending if file_progress[index] == job.files[index][2] and index not in done]
                 
-                else:
-                    # Download phase
-                    info = handle.get_torrent_info()
-                    total_size = info.total_size()
-                    
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, f"Torrent size ({format_bytes(total_size)}) exceeds limit."
-                    
-                    progress = s.progress * 100
+                if done:
+                    await self.torrents.call('flush', job.key)
+                for index in done:
+                    pending.discard(index)
+                    paths[index] = os.path.join(job.job_dir, job.files[index][1])
+                    if on_file:
+                        tasks.append(asyncio.create_task(on_file(paths[index])))
+                
+                progress = s.total_wanted_done * 100 / s.total_wanted if s.total_wanted else 0
+                if progress_callback and abs(progress - last_progress) >= 1:
+                    last_progress = progress
                     download_rate = s.download_rate / 1024 / 1024 # MB/s
-                    
-                    if progress_callback and abs(progress - last_progress) >= 1:
-                        last_progress = progress
-                        status_msg = f"Torrenting | ↓ {download_rate:.1f} MB/s | {s.num_peers} peers | {progress:.1f}%"
-                        await progress_callback(int(s.total_done), total_size, status_msg)
-
-                # Wait for 1 second before the next loop iteration
-                await asyncio.sleep(1)
-
-            # 5. Finalize (after seeding)
-            info = handle.get_torrent_info()
-            name = info.name()
-
-            # Determine final file path
-            if info.num_files() == 1:
-                filepath = os.path.join(self.torrent_dir, info.files().file_path(0))
-            else:
-                filepath = os.path.join(self.torrent_dir, name)
+                    status_msg = f"Torrenting | ↓ {download_rate:.1f} MB/s | {s.num_peers} peers | {progress:.1f}%"
+                    await progress_callback(int(s.total_wanted_done), int(s.total_wanted), status_msg)
             
-            return filepath, None
+            await asyncio.gather(*tasks)
+            return [paths[index] for index in indices], None
             
+        except (DownloadError, TorrentError) as e:
+            return None, str(e)
         except Exception as e:
             return None, f"Torrent error: {str(e)}"
         finally:
-            # Clean up the handle and session
-            if ses and handle and handle.is_valid():
-                ses.remove_torrent(handle)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def close_torrent(self, job, keep_files=False):
+        """Release a request's hold on an opened torrent
+
+        The last request to close it removes it from the session, with its
+        files unless one of them asked to `keep_files`.
+        """
+        if self._closing:
+            # Shutting down - the worker saves its resume data, so the files stay for the next run
+            return
+        job.keep_files = job.keep_files or keep_files
+        job.refs -= 1
+        if job.refs > 0:
+            return
+        if self._torrent_jobs.get(job.key) is job:
+            del self._torrent_jobs[job.key]
+        self.torrents.unwatch(job.key)
+        # Also deletes its resume data - the reply isn't needed
+        self.torrents.post('remove', job.key)
+        if job.reservation:
+            job.reservation.release()
+            job.reservation = None
+        if not job.keep_files:
+            shutil.rmtree(job.job_dir, ignore_errors=True)
+            for path in [path for path in self._hashes if path.startswith(job.job_dir + os.sep)]:
+                del self._hashes[path]
 
-    async def download(self, url_or_file, filename=None, progress_callback=None):
-        """Main download function - auto-detects type"""
+    async def download_torrent(self, magnet_or_file, progress_callback=None, job_dir=None):
+        """Download every file of a torrent - a single file's path, or the torrent's directory"""
+        job, error = await self.open_torrent(magnet_or_file, progress_callback, job_dir)
+        if error:
+            return None, error
         
+        filepath = None
+        try:
+            if job.total_size > Config.MAX_FILE_SIZE:
+                return None, f"Torrent size ({format_bytes(job.total_size)}) exceeds limit."
+            
+            paths, error = await self.fetch_torrent_files(job, range(len(job.files)), progress_callback)
+            if error:
+                return None, error
+            
+            # Determine final file path
+            filepath = paths[0] if len(paths) == 1 else os.path.join(job.job_dir, job.name)
+            if job.refs == 1:
+                self._keep_reservation(filepath, job.reservation)
+                job.reservation = None
+            return filepath, None
+        finally:
+            # Drop the torrent - the worker's session lives on for the next one
+            self.close_torrent(job, keep_files=filepath is not None)
+
+    async def download(self, url_or_file, filename=None, progress_callback=None, user_id=None, stream=None, ytdlp_format=None, playlist_item=None):
+        """Main download function - identical concurrent requests share one transfer
+
+        Every caller gets its own progress updates and its own reference to the
+        result; release it with `cleanup()` once done with the file. A `stream`
+        sink is started only for HTTP downloads of known size that it joined
+        from the beginning - check `stream.started` afterwards.
+        """
         if not url_or_file:
             return None, "No URL or file provided"
         
-        if isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent')):
-            return await self.download_torrent(url_or_file, progress_callback)
+        source = normalize_url(url_or_file) if is_url(url_or_file) else url_or_file.strip()
+        key = (source, filename, ytdlp_format, playlist_item)
         
-        video_domains = [
-            'youtube.com', 'youtu.be', 'instagram.com', 'facebook.com', 
-            'twitter.com', 'tiktok.com', 'vimeo.com', 'dailymotion.com',
-            'vt.tiktok.com', 'vm.tiktok.com', 'x.com', 'twitch.tv',
-            'reddit.com', 'streamable.com', 'imgur.com'
-        ]
+        flight = self._inflight.get(key)
+        if flight is None or flight.task.done():
+            flight = DownloadFlight()
+            flight.task = asyncio.create_task(self._download(url_or_file, filename, flight.progress, user_id, flight, ytdlp_format, playlist_item))
+            self._inflight[key] = flight
+            
+            def forget(_, key=key, flight=flight):
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+            
+            flight.task.add_done_callback(forget)
+        else:
+            print(f"Joining in-flight download of {source}")
+        
+        flight.consumers += 1
+        if progress_callback:
+            flight.callbacks.append(progress_callback)
+        if stream:
+            flight.sinks.append(stream)
         
-        is_video_url = any(domain in url_or_file.lower() for domain in video_domains)
+        try:
+            filepath, error = await asyncio.shield(flight.task)
+        finally:
+            flight.consumers -= 1
+            if progress_callback in flight.callbacks:
+                flight.callbacks.remove(progress_callback)
+            if stream in flight.sinks:
+                flight.sinks.remove(stream)
+            # Stop the transfer only when nobody is waiting for it any more - and
+            # forget it at once, so a new request starts afresh instead of joining it while it unwinds
+            if not flight.consumers and not flight.task.done():
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
         
-        if is_video_url:
-            return await self.download_ytdlp(url_or_file, progress_callback)
+        if filepath:
+            self._refs[filepath] = self._refs.get(filepath, 0) + 1
+        return filepath, error
+
+    def _is_manifest(self, url):
+        """Whether a URL points straight at an HLS or DASH manifest"""
+        path = urlsplit(url).path.lower()
+        return path.endswith(('.m3u8', '.mpd'))
+
+    async def _match_extractors(self, url, host):
+        """Whether a yt-dlp extractor other than the generic one accepts url
+
+        The extractor patterns are matched in the yt-dlp worker pool. Hosts where
+        nothing matched are remembered for ROUTE_TTL, so only the first URL of a
+        new host pays for scanning the full extractor list.
+        """
+        now = time.time()
+        if self._unmatched_hosts.get(host, 0) > now:
+            return False
+        
+        keys, error = await self.ytdlp.match(url)
+        if error:
+            print(f"Extractor match failed for {url}: {error}")
+            return False
+        
+        for stale in [h for h, expires in self._unmatched_hosts.items() if expires <= now]:
+            del self._unmatched_hosts[stale]
+        if keys:
+            self._unmatched_hosts.pop(host, None)
+        else:
+            self._unmatched_hosts[host] = now + ROUTE_TTL
+        return bool(keys)
+
+    async def _sniff_html(self, url):
+        """HEAD the URL - a web page may embed a video, anything else is a file"""
+        try:
+            session = await self.get_session()
+            async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                return response.content_type == 'text/html'
+        except Exception as e:
+            print(f"HEAD sniff failed for {url}: {e}")
+            return False
+
+    async def is_ytdlp_url(self, url):
+        """Whether a URL should be handled by yt-dlp rather than downloaded as a plain file
+
+        Config.HTTP_DOMAINS and Config.YTDLP_DOMAINS decide first, then yt-dlp's
+        own extractor patterns, then the content type of a HEAD request.
+        """
+        host = url_host(url)
+        if not host:
+            return False
+        if self.http_domains.match(host):
+            return False
+        if self.ytdlp_domains.match(host):
+            return True
+        
+        key = normalize_url(url)
+        now = time.time()
+        cached = self._routes.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        
+        use_ytdlp = await self._match_extractors(url, host) or await self._sniff_html(url)
+        
+        for stale in [k for k, (expires, _) in self._routes.items() if expires <= now]:
+            del self._routes[stale]
+        self._routes[key] = (now + ROUTE_TTL, use_ytdlp)
+        return use_ytdlp
+
+    async def _download(self, url_or_file, filename=None, progress_callback=None, user_id=None, stream=None, ytdlp_format=None, playlist_item=None):
+        """Auto-detect the source type and download it into a fresh job directory"""
+        is_torrent = isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent'))
+        job_dir = self.new_job_dir(self.torrent_dir if is_torrent else self.jobs_dir)
+        
+        try:
+            if is_torrent:
+                result = await self.download_torrent(url_or_file, progress_callback, job_dir)
+            else:
+                if not playlist_item and self._is_manifest(url_or_file):
+                    result = await self.download_manifest(url_or_file, filename, progress_callback, user_id, job_dir)
+                elif playlist_item or await self.is_ytdlp_url(url_or_file):
+                    result = await self.download_ytdlp(url_or_file, progress_callback, user_id, job_dir, ytdlp_format, playlist_item)
+                else:
+                    result = await self.download_file(url_or_file, filename, progress_callback, user_id, stream, job_dir)
+        except BaseException:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        
+        if not result[0]:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        return result
+    
+    def rename(self, filepath, new_name):
+        """Give the caller's copy of a download a new name without disturbing other consumers"""
+        new_path = os.path.join(os.path.dirname(filepath), new_name)
+        if new_path == filepath:
+            return filepath
+        
+        if self._refs.get(filepath, 1) > 1:
+            # Shared with other consumers - link (or copy) into a job directory of our own
+            job_dir = self._job_dir_of(filepath)
+            if job_dir:
+                new_path = os.path.join(self.new_job_dir(os.path.dirname(job_dir)), new_name)
+            try:
+                os.link(filepath, new_path)
+            except OSError:
+                shutil.copy2(filepath, new_path)
+            if filepath in self._hashes:
+                self._hashes[new_path] = self._hashes[filepath]
+            self.cleanup(filepath)
         else:
-            return await self.download_file(url_or_file, filename, progress_callback)
+            os.replace(filepath, new_path)
+            self._refs.pop(filepath, None)
+            if filepath in self._hashes:
+                self._hashes[new_path] = self._hashes.pop(filepath)
+            reservation = self._reservations.pop(filepath, None)
+            if reservation:
+                self._keep_reservation(new_path, reservation)
+        
+        self._refs[new_path] = self._refs.get(new_path, 0) + 1
+        return new_path
+    
+    async def content_hash(self, filepath):
+        """Block-wise SHA-256 of a downloaded file (see helpers.ContentHasher)
+
+        HTTP downloads hash while writing and the yt-dlp worker hashes its file
+        right after writing it. Torrent files, written piece by piece out of
+        order by libtorrent, are read once in a worker thread instead.
+        """
+        if filepath in self._hashes:
+            return self._hashes[filepath]
+        if not filepath or not os.path.isfile(filepath):
+            return None
+        
+        digest = await asyncio.get_running_loop().run_in_executor(None, hash_file, filepath, Config.HASH_BLOCK_SIZE)
+        self._hashes[filepath] = digest
+        return digest
     
     def cleanup(self, filepath):
-        """Remove downloaded file or directory"""
+        """Release a reference to a download - the last consumer removes it along with its job directory"""
+        refs = self._refs.get(filepath, 1) - 1
+        if refs > 0:
+            self._refs[filepath] = refs
+            return True
+        self._refs.pop(filepath, None)
+        self._hashes.pop(filepath, None)
+        reservation = self._reservations.pop(filepath, None)
+        
+        job_dir = self._job_dir_of(filepath)
+        if job_dir and not any(self._job_dir_of(path) == job_dir for path in self._refs):
+            filepath = job_dir
+        
         try:
             if os.path.isfile(filepath):
                 os.remove(filepath)
@@ -305,5 +1522,8 @@ class Downloader:
         except Exception as e:
             print(f"Cleanup error: {e}")
             return False
+        finally:
+            if reservation:
+                reservation.release()
 
 downloader = Downloader()
@@ -1,8 +1,10 @@
 import time
 import asyncio
 import math
+import hashlib
+import threading
 from typing import Optional
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 
 class Progress:
     """Progress tracker for downloads and uploads with stunning UI - Optimized"""
@@ -177,6 +179,180 @@ async def speed_limiter(chunk_size, speed_limit):
     if delay > 0.001:  # Only sleep if delay is meaningful
         await asyncio.sleep(delay)
 
+class TokenBucket:
+    """Token bucket that lets callers go into debt and tells them how long to wait it off"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+    
+    def consume(self, nbytes, now):
+        """Take nbytes and return the seconds to wait before the bucket is out of debt"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class BandwidthScheduler:
+    """Shared bandwidth scheduler for every download and upload - Thread safe
+    
+    Enforces a global cap, splits it fairly between the users that are
+    currently transferring, and keeps a reserved slice of it for uploads
+    whenever an upload is running.
+    """
+    
+    ACTIVE_WINDOW = 2.0  # Seconds without traffic before a user stops counting as active
+    
+    def __init__(self, limit, upload_share=0.2, burst=8 * 1024 * 1024):
+        self.limit = limit
+        self.upload_share = upload_share
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._global = TokenBucket(limit, burst)
+        self._buckets = {}  # (direction, user_id) -> TokenBucket
+        self._seen = {}  # (direction, user_id) -> last transfer time
+    
+    def _reserve(self, nbytes, user_id, direction):
+        """Charge nbytes to the global and per-user buckets and return the delay owed"""
+        if self.limit <= 0 or nbytes <= 0:
+            return 0
+        
+        key = (direction, user_id)
+        with self._lock:
+            now = time.monotonic()
+            self._seen[key] = now
+            for other, seen in list(self._seen.items()):
+                if now - seen > self.ACTIVE_WINDOW:
+                    del self._seen[other]
+                    self._buckets.pop(other, None)
+            
+            active = {'download': 0, 'upload': 0}
+            for other_direction, _ in self._seen:
+                active[other_direction] += 1
+            
+            # Downloads leave the reserved slice alone while any upload is running
+            class_rate = self.limit
+            if direction == 'download' and active['upload']:
+                class_rate = self.limit * (1 - self.upload_share)
+            
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(class_rate, self.burst)
+            bucket.rate = class_rate / active[direction]
+            
+            return max(bucket.consume(nbytes, now), self._global.consume(nbytes, now))
+    
+    async def acquire(self, nbytes, user_id=None, direction='download'):
+        """Wait until nbytes may be transferred"""
+        delay = self._reserve(nbytes, user_id, direction)
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+    
+    def acquire_sync(self, nbytes, user_id=None, direction='download'):
+        """Blocking variant of acquire() for worker threads"""
+        delay = self._reserve(nbytes, user_id, direction)
+        if delay > 0.001:
+            time.sleep(delay)
+    
+    def throttle_progress(self, progress_callback, user_id=None, direction='upload'):
+        """Wrap a Pyrogram progress callback so the transfer it reports on is rate limited"""
+        state = {'last': 0}
+        
+        async def callback(current, total, *args):
+            await self.acquire(current - state['last'], user_id, direction)
+            state['last'] = current
+            await progress_callback(current, total, *args)
+        
+        return callback
+
+def merge_range(ranges, start, end):
+    """Add [start, end) to a sorted list of disjoint [start, end) ranges, merging neighbours"""
+    merged = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+def range_covered(ranges, start, end):
+    """Check whether [start, end) lies entirely inside one of the merged ranges"""
+    return any(s <= start and end <= e for s, e in ranges)
+
+class ContentHasher:
+    """Block-wise SHA-256 content hash that can be fed while a file downloads
+    
+    The file is split into fixed-size blocks that are hashed independently as
+    their bytes arrive, and the final digest is SHA-256 over the block
+    digests. Segments may complete in any order - only the bytes inside one
+    block have to arrive in order - so the result never depends on how the
+    download was split.
+    """
+    
+    def __init__(self, block_size, digests=None):
+        self.block_size = block_size
+        self.digests = {int(index): digest for index, digest in (digests or {}).items()}
+        self.valid = True
+        self._open = {}  # block index -> [sha256, bytes hashed so far]
+    
+    def update(self, offset, data):
+        """Hash data that belongs at offset in the file"""
+        view = memoryview(data)
+        while view and self.valid:
+            index, start = divmod(offset, self.block_size)
+            take = min(len(view), self.block_size - start)
+            
+            entry = self._open.get(index)
+            if entry is None and start == 0:
+                entry = self._open[index] = [hashlib.sha256(), 0]
+            if entry is None or entry[1] != start:
+                # Bytes arrived out of order inside a block - the hash can't be trusted
+                self.valid = False
+                return
+            
+            entry[0].update(view[:take])
+            entry[1] += take
+            if entry[1] == self.block_size:
+                self.digests[index] = entry[0].hexdigest()
+                del self._open[index]
+            
+            view = view[take:]
+            offset += take
+    
+    def hexdigest(self, total_size):
+        """Final content hash once every byte of a total_size file was fed, otherwise None"""
+        if not self.valid or total_size <= 0:
+            return None
+        
+        blocks = -(-total_size // self.block_size)
+        last = blocks - 1
+        entry = self._open.get(last)
+        if entry and entry[1] == total_size - last * self.block_size:
+            self.digests[last] = entry[0].hexdigest()
+            del self._open[last]
+        
+        combined = hashlib.sha256()
+        for index in range(blocks):
+            if index not in self.digests:
+                return None
+            combined.update(bytes.fromhex(self.digests[index]))
+        return combined.hexdigest()
+
+def hash_file(path, block_size):
+    """ContentHasher digest of a finished file - for files written by another process"""
+    hasher = ContentHasher(block_size)
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hasher.update(offset, block)
+            offset += len(block)
+    return hasher.hexdigest(offset)
+
 def is_url(text):
     """Check if text is a valid URL - Optimized"""
     if not text or not isinstance(text, str):
@@ -188,6 +364,64 @@ def is_url(text):
     return (text_lower.startswith(('http://', 'https://', 'ftp://', 'ftps://')) or 
             text_lower.startswith('www.'))
 
+# Query parameters that only track where a link was shared from
+_TRACKING_PARAMS = {'fbclid', 'gclid', 'igshid', 'si', 'feature', 'ref', 'ref_src'}
+
+def normalize_url(url):
+    """Canonical form of a URL for cache keys - lowercase host, no fragment, sorted query, no tracking params"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url
+    
+    if host.startswith('www.'):
+        host = host[4:]
+    netloc = host if port is None or (scheme, port) in (('http', 80), ('https', 443)) else f"{host}:{port}"
+    
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in _TRACKING_PARAMS
+    )
+    
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(query), ''))
+
+def url_host(url):
+    """Lowercase host name of a URL, without a leading www. - empty if it has none"""
+    url = url.strip()
+    if url.lower().startswith('www.'):
+        url = 'http://' + url
+    try:
+        host = (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+    return host[4:] if host.startswith('www.') else host
+
+class DomainIndex:
+    """Set of domains matched against a host and all of its parent domains
+
+    `youtube.com` also matches `m.youtube.com`, but not `notyoutube.com`.
+    A lookup costs one set probe per label of the host name.
+    """
+    
+    def __init__(self, domains=()):
+        self.domains = {domain.lower().strip('.') for domain in domains}
+    
+    def add(self, domain):
+        self.domains.add(domain.lower().strip('.'))
+    
+    def match(self, host):
+        """The indexed domain covering host, or None"""
+        labels = host.lower().split('.')
+        for i in range(len(labels)):
+            candidate = '.'.join(labels[i:])
+            if candidate in self.domains:
+                return candidate
+        return None
+
 def is_magnet(text):
     """Check if text is a magnet link - Optimized"""
     if not text or not isinstance(text, str):
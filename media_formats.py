@@ -0,0 +1,300 @@
+"""Format selection and streaming manifest parsing - pure functions, no I/O"""
+import re
+import math
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin
+
+# Auxiliary function for formatting file sizes
+def format_bytes(size):
+    """Format bytes into human-readable string (e.g., 1.2 GB)"""
+    power = 2**10
+    n = 0
+    units = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
+    while size > power:
+        size /= power
+        n += 1
+    return f"{size:.2f} {units[n]}"
+
+def _format_size(fmt, duration):
+    """Size of a yt-dlp format in bytes - reported, approximate or estimated from its bitrate"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size or 0)
+
+def ytdlp_format_choices(info, max_size):
+    """Best format per resolution that fits in max_size, highest resolution first
+
+    Video-only formats are paired with the best audio-only format. Each choice
+    is a dict with the yt-dlp format `spec`, `height`, estimated `size` and a
+    button `label`.
+    """
+    formats = info.get('formats') or []
+    duration = info.get('duration')
+    
+    audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    best_audio = max(audio, key=lambda f: f.get('abr') or f.get('tbr') or 0, default=None)
+    
+    choices = {}
+    for f in formats:
+        height = f.get('height')
+        if not height or f.get('vcodec') in (None, 'none'):
+            continue
+        
+        spec = f['format_id']
+        size = _format_size(f, duration)
+        if f.get('acodec') in (None, 'none'):
+            if not best_audio:
+                continue
+            spec = f"{f['format_id']}+{best_audio['format_id']}"
+            audio_size = _format_size(best_audio, duration)
+            size = size + audio_size if size and audio_size else 0
+        
+        if not size or size > max_size:
+            continue
+        
+        current = choices.get(height)
+        if current is None or (f.get('tbr') or 0) > current['tbr']:
+            choices[height] = {
+                'spec': spec,
+                'height': height,
+                'size': size,
+                'tbr': f.get('tbr') or 0,
+                'label': f"{height}p • {format_bytes(size)}"
+            }
+    
+    return sorted(choices.values(), key=lambda c: c['height'], reverse=True)
+
+def ytdlp_fallback_format(info, max_size):
+    """(spec, size) for sources ytdlp_format_choices() has nothing for - audio-only, or no height/codec reported
+
+    The spec lets yt-dlp pick the best format under max_size, falling back
+    to audio-only formats. `size` is the largest reported size that fits,
+    0 when no format reports one. Returns (None, 0) if every format with a
+    known size is over max_size.
+    """
+    duration = info.get('duration')
+    sizes = [size for size in (_format_size(f, duration) for f in info.get('formats') or []) if size]
+    if sizes and min(sizes) > max_size:
+        return None, 0
+    
+    limit = f"[filesize<?{max_size}][filesize_approx<?{max_size}]"
+    spec = f"best{limit}/bestvideo{limit}+bestaudio{limit}/bestaudio{limit}/best"
+    return spec, max((size for size in sizes if size <= max_size), default=0)
+
+def _hls_attributes(text):
+    """Parse an HLS attribute list - KEY=value,KEY="quoted, value" """
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+def _hls_byterange(value, next_offset=0):
+    """`length[@offset]` as an inclusive (start, end) range"""
+    length, _, offset = value.partition('@')
+    start = int(offset) if offset else next_offset
+    return start, start + int(length) - 1
+
+def parse_hls_master(text, base_url):
+    """Variants of an HLS master playlist, highest bandwidth first
+
+    Each variant is a dict with its playlist `url`, `bandwidth` and the
+    `audio_url` of a separate audio rendition, if it uses one.
+    """
+    audio = {}
+    variants = []
+    stream_inf = None
+    
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA:'):
+            attrs = _hls_attributes(line[13:])
+            if attrs.get('TYPE') == 'AUDIO' and attrs.get('URI'):
+                group = audio.setdefault(attrs.get('GROUP-ID'), [])
+                # The default rendition of a group is preferred
+                group.insert(0 if attrs.get('DEFAULT') == 'YES' else len(group), urljoin(base_url, attrs['URI']))
+        elif line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = _hls_attributes(line[18:])
+        elif line and not line.startswith('#') and stream_inf is not None:
+            variants.append({
+                'url': urljoin(base_url, line),
+                'bandwidth': int(stream_inf.get('BANDWIDTH', 0)),
+                'audio': stream_inf.get('AUDIO')
+            })
+            stream_inf = None
+    
+    for variant in variants:
+        renditions = audio.get(variant.pop('audio'))
+        variant['audio_url'] = renditions[0] if renditions else None
+    
+    return sorted(variants, key=lambda v: v['bandwidth'], reverse=True)
+
+def parse_hls_media(text, base_url):
+    """Segments of an HLS media playlist and its duration in seconds
+
+    Segments are (url, byte_range) pairs in playback order, with fMP4 init
+    sections inserted wherever they change. Returns None for live and
+    encrypted playlists, which are left to yt-dlp.
+    """
+    segments = []
+    duration = 0.0
+    byte_range = None
+    next_offset = 0
+    init = None
+    ended = False
+    
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration += float(line[8:].split(',')[0] or 0)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byte_range = _hls_byterange(line[17:], next_offset)
+            next_offset = byte_range[1] + 1
+        elif line.startswith('#EXT-X-MAP:'):
+            attrs = _hls_attributes(line[11:])
+            section = (urljoin(base_url, attrs['URI']), _hls_byterange(attrs['BYTERANGE']) if 'BYTERANGE' in attrs else None)
+            if section != init:
+                segments.append(section)
+                init = section
+        elif line.startswith('#EXT-X-KEY:'):
+            if _hls_attributes(line[11:]).get('METHOD', 'NONE') != 'NONE':
+                return None
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif line and not line.startswith('#'):
+            segments.append((urljoin(base_url, line), byte_range))
+            byte_range = None
+    
+    if not ended:
+        return None
+    return segments, duration
+
+def segments_size(segments):
+    """Total bytes of (url, byte_range) segments - None unless every segment has a byte range"""
+    if not segments or any(byte_range is None for _, byte_range in segments):
+        return None
+    return sum(last - first + 1 for _, (first, last) in segments)
+
+def _iso_duration(value):
+    """Seconds in an ISO 8601 duration such as PT1H2M3.5S"""
+    match = re.match(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$', value or '')
+    if not match:
+        return 0
+    days, hours, minutes, seconds = (float(part or 0) for part in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+def _mpd_base(base_url, element):
+    """Resolve an element's BaseURL against its parent's"""
+    base = element.find('{*}BaseURL')
+    return urljoin(base_url, base.text.strip()) if base is not None and base.text else base_url
+
+def _mpd_range(value):
+    """`start-end` as an inclusive (start, end) range"""
+    if not value:
+        return None
+    start, _, end = value.partition('-')
+    return int(start), int(end)
+
+def _mpd_segments(representation, adaptation, base_url, duration):
+    """(url, byte_range) segments of one DASH representation, or None if it can't be fetched natively"""
+    # SegmentTemplate attributes are inherited from the AdaptationSet
+    template = {}
+    timeline = None
+    for element in (adaptation, representation):
+        node = element.find('{*}SegmentTemplate')
+        if node is not None:
+            template.update(node.attrib)
+            if node.find('{*}SegmentTimeline') is not None:
+                timeline = node.find('{*}SegmentTimeline')
+    
+    if template:
+        def fill(pattern, number=0, start_time=0):
+            values = {
+                'RepresentationID': representation.get('id', ''),
+                'Number': number,
+                'Bandwidth': representation.get('bandwidth', ''),
+                'Time': start_time
+            }
+            return re.sub(
+                r'\$(RepresentationID|Number|Bandwidth|Time)(?:%0(\d+)d)?\$',
+                lambda m: str(values[m.group(1)]).zfill(int(m.group(2) or 0)),
+                pattern
+            ).replace('$$', '$')
+        
+        segments = []
+        if 'initialization' in template:
+            segments.append((urljoin(base_url, fill(template['initialization'])), None))
+        
+        number = int(template.get('startNumber', 1))
+        if timeline is not None:
+            start_time = 0
+            for entry in timeline.findall('{*}S'):
+                start_time = int(entry.get('t', start_time))
+                repeat = int(entry.get('r', 0))
+                if repeat < 0:
+                    return None
+                for _ in range(repeat + 1):
+                    segments.append((urljoin(base_url, fill(template['media'], number, start_time)), None))
+                    start_time += int(entry.get('d'))
+                    number += 1
+        elif template.get('duration') and duration:
+            segment_duration = int(template['duration'])
+            count = math.ceil(duration * int(template.get('timescale', 1)) / segment_duration)
+            for index in range(count):
+                segments.append((urljoin(base_url, fill(template['media'], number + index, index * segment_duration)), None))
+        else:
+            return None
+        return segments
+    
+    segment_list = representation.find('{*}SegmentList')
+    if segment_list is None:
+        segment_list = adaptation.find('{*}SegmentList')
+    if segment_list is not None:
+        segments = []
+        init = segment_list.find('{*}Initialization')
+        if init is not None:
+            segments.append((urljoin(base_url, init.get('sourceURL', '')), _mpd_range(init.get('range'))))
+        for entry in segment_list.findall('{*}SegmentURL'):
+            segments.append((urljoin(base_url, entry.get('media', '')), _mpd_range(entry.get('mediaRange'))))
+        return segments
+    
+    # SegmentBase or a bare BaseURL - the whole track is one file
+    return [(base_url, None)]
+
+def parse_mpd(text, base_url):
+    """Video and audio representations of a DASH manifest and its duration in seconds
+
+    Each representation is a dict with its content `type`, `bandwidth` and
+    `segments`. Returns None for live, multi-period and DRM protected
+    manifests, which are left to yt-dlp.
+    """
+    root = ET.fromstring(text)
+    periods = root.findall('{*}Period')
+    if root.get('type') == 'dynamic' or len(periods) != 1:
+        return None
+    
+    period = periods[0]
+    duration = _iso_duration(period.get('duration') or root.get('mediaPresentationDuration'))
+    period_base = _mpd_base(_mpd_base(base_url, root), period)
+    
+    representations = []
+    for adaptation in period.findall('{*}AdaptationSet'):
+        if adaptation.find('{*}ContentProtection') is not None:
+            return None
+        adaptation_base = _mpd_base(period_base, adaptation)
+        
+        for representation in adaptation.findall('{*}Representation'):
+            mime_type = representation.get('mimeType') or adaptation.get('mimeType') or ''
+            content_type = adaptation.get('contentType') or mime_type.split('/')[0]
+            if content_type not in ('video', 'audio'):
+                continue
+            if representation.find('{*}ContentProtection') is not None:
+                return None
+            
+            segments = _mpd_segments(representation, adaptation, _mpd_base(adaptation_base, representation), duration)
+            if segments is None:
+                return None
+            representations.append({
+                'type': content_type,
+                'bandwidth': int(representation.get('bandwidth', 0)),
+                'segments': segments
+            })
+    
+    return representations, duration
@@ -0,0 +1,164 @@
+import unittest
+from media_formats import ytdlp_format_choices, ytdlp_fallback_format, parse_hls_master, parse_hls_media, parse_mpd, segments_size
+
+MB = 1024 * 1024
+
+
+class YtdlpFormatChoicesTest(unittest.TestCase):
+    def test_best_format_per_height_highest_first(self):
+        info = {'duration': 60, 'formats': [
+            {'format_id': '18', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'tbr': 500, 'filesize': 5 * MB},
+            {'format_id': '22', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 720, 'tbr': 1500, 'filesize': 15 * MB},
+            {'format_id': '22b', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 720, 'tbr': 1000, 'filesize': 10 * MB},
+        ]}
+        choices = ytdlp_format_choices(info, 100 * MB)
+        self.assertEqual([c['spec'] for c in choices], ['22', '18'])
+        self.assertEqual(choices[0]['size'], 15 * MB)
+
+    def test_video_only_paired_with_best_audio(self):
+        info = {'duration': 60, 'formats': [
+            {'format_id': '137', 'vcodec': 'avc1', 'acodec': 'none', 'height': 1080, 'tbr': 4000, 'filesize': 30 * MB},
+            {'format_id': '139', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': 48, 'filesize': 1 * MB},
+            {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': 128, 'filesize': 2 * MB},
+        ]}
+        choices = ytdlp_format_choices(info, 100 * MB)
+        self.assertEqual(choices[0]['spec'], '137+140')
+        self.assertEqual(choices[0]['size'], 32 * MB)
+
+    def test_oversize_and_unsized_formats_dropped(self):
+        info = {'formats': [
+            {'format_id': 'big', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 1080, 'filesize': 200 * MB},
+            {'format_id': 'unknown', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 720},
+        ]}
+        self.assertEqual(ytdlp_format_choices(info, 100 * MB), [])
+
+    def test_size_estimated_from_bitrate(self):
+        info = {'duration': 100, 'formats': [
+            {'format_id': 'a', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 480, 'tbr': 800},
+        ]}
+        self.assertEqual(ytdlp_format_choices(info, 100 * MB)[0]['size'], 800 * 1000 // 8 * 100)
+
+
+class YtdlpFallbackFormatTest(unittest.TestCase):
+    def test_audio_only_source_is_accepted(self):
+        info = {'formats': [{'format_id': 'mp3', 'vcodec': 'none', 'acodec': 'mp3', 'filesize': 5 * MB}]}
+        self.assertEqual(ytdlp_format_choices(info, 4096 * MB), [])
+        spec, size = ytdlp_fallback_format(info, 4096 * MB)
+        self.assertIn('bestaudio', spec)
+        self.assertEqual(size, 5 * MB)
+
+    def test_unsized_formats_are_accepted(self):
+        spec, size = ytdlp_fallback_format({'formats': [{'format_id': 'x'}]}, 100 * MB)
+        self.assertIsNotNone(spec)
+        self.assertEqual(size, 0)
+
+    def test_rejected_only_when_every_sized_format_is_oversize(self):
+        info = {'formats': [
+            {'format_id': 'a', 'filesize': 200 * MB},
+            {'format_id': 'b', 'filesize': 300 * MB},
+            {'format_id': 'c'},
+        ]}
+        self.assertEqual(ytdlp_fallback_format(info, 100 * MB), (None, 0))
+        info['formats'].append({'format_id': 'd', 'filesize': 50 * MB})
+        self.assertEqual(ytdlp_fallback_format(info, 100 * MB)[1], 50 * MB)
+
+
+class HlsParserTest(unittest.TestCase):
+    def test_master_sorted_by_bandwidth_with_audio_group(self):
+        text = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="alt",URI="audio/alt.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="main",DEFAULT=YES,URI="audio/main.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=3000000,CODECS="avc1.64001f,mp4a.40.2",AUDIO="aud"
+high.m3u8
+"""
+        variants = parse_hls_master(text, 'https://cdn.example/v/master.m3u8')
+        self.assertEqual([v['url'] for v in variants], ['https://cdn.example/v/high.m3u8', 'https://cdn.example/v/low.m3u8'])
+        self.assertEqual(variants[0]['audio_url'], 'https://cdn.example/v/audio/main.m3u8')
+        self.assertIsNone(variants[1]['audio_url'])
+
+    def test_media_segments_byteranges_and_init(self):
+        text = """#EXTM3U
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="100@0"
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@100
+video.mp4
+#EXTINF:2.5,
+#EXT-X-BYTERANGE:500
+video.mp4
+#EXT-X-ENDLIST
+"""
+        segments, duration = parse_hls_media(text, 'https://cdn.example/v/index.m3u8')
+        self.assertEqual(segments, [
+            ('https://cdn.example/v/init.mp4', (0, 99)),
+            ('https://cdn.example/v/video.mp4', (100, 1099)),
+            ('https://cdn.example/v/video.mp4', (1100, 1599)),
+        ])
+        self.assertAlmostEqual(duration, 6.5)
+        self.assertEqual(segments_size(segments), 1600)
+
+    def test_size_unknown_without_byteranges(self):
+        segments, _ = parse_hls_media("#EXTM3U\n#EXTINF:4.0,\nseg1.ts\n#EXT-X-ENDLIST\n", 'https://cdn.example/')
+        self.assertIsNone(segments_size(segments))
+
+    def test_live_and_encrypted_playlists_are_left_to_ytdlp(self):
+        live = "#EXTM3U\n#EXTINF:4.0,\nseg1.ts\n"
+        encrypted = '#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="key"\n#EXTINF:4.0,\nseg1.ts\n#EXT-X-ENDLIST\n'
+        self.assertIsNone(parse_hls_media(live, 'https://cdn.example/'))
+        self.assertIsNone(parse_hls_media(encrypted, 'https://cdn.example/'))
+
+
+MPD_TEMPLATE = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <Period>
+    <AdaptationSet contentType="video" mimeType="video/mp4">
+      {protection}
+      <SegmentTemplate initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number%03d$.m4s" startNumber="1" duration="4" timescale="1"/>
+      <Representation id="v1" bandwidth="2000000"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4">
+      <Representation id="a1" bandwidth="128000">
+        <BaseURL>audio.mp4</BaseURL>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+
+
+class MpdParserTest(unittest.TestCase):
+    def test_template_and_single_file_representations(self):
+        representations, duration = parse_mpd(MPD_TEMPLATE.format(protection=''), 'https://cdn.example/d/manifest.mpd')
+        self.assertEqual(duration, 10)
+        video, audio = representations
+        self.assertEqual(video['type'], 'video')
+        self.assertEqual(video['bandwidth'], 2000000)
+        self.assertEqual([url for url, _ in video['segments']], [
+            'https://cdn.example/d/v1/init.mp4',
+            'https://cdn.example/d/v1/001.m4s',
+            'https://cdn.example/d/v1/002.m4s',
+            'https://cdn.example/d/v1/003.m4s',
+        ])
+        self.assertEqual(audio['segments'], [('https://cdn.example/d/audio.mp4', None)])
+
+    def test_segment_timeline_numbers_and_times(self):
+        text = """<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT6S">
+  <Period><AdaptationSet contentType="video">
+    <SegmentTemplate media="seg-$Time$.m4s"><SegmentTimeline><S t="0" d="2" r="2"/></SegmentTimeline></SegmentTemplate>
+    <Representation id="v" bandwidth="1"/>
+  </AdaptationSet></Period>
+</MPD>"""
+        (video,), _ = parse_mpd(text, 'https://cdn.example/')
+        self.assertEqual([url for url, _ in video['segments']], [
+            'https://cdn.example/seg-0.m4s', 'https://cdn.example/seg-2.m4s', 'https://cdn.example/seg-4.m4s'
+        ])
+
+    def test_drm_and_live_manifests_are_left_to_ytdlp(self):
+        protected = MPD_TEMPLATE.format(protection='<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011"/>')
+        self.assertIsNone(parse_mpd(protected, 'https://cdn.example/'))
+        live = MPD_TEMPLATE.format(protection='').replace('type="static"', 'type="dynamic"')
+        self.assertIsNone(parse_mpd(live, 'https://cdn.example/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
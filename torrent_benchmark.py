@@ -0,0 +1,151 @@
+"""Loopback benchmark for the libtorrent profiles in Config.TORRENT_PROFILES
+
+A seeder session shares a generated file on 127.0.0.1 and a fresh leecher
+process downloads it once per profile, so every profile starts from a cold
+process and its peak memory is its own.
+
+    python torrent_benchmark.py                  # every profile, 512 MB payload
+    python torrent_benchmark.py server low_memory --size 2048
+"""
+import os
+import sys
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+import libtorrent as lt
+from config import Config
+from torrent_session import session_settings, storage_mode
+
+# Keep both sessions on loopback - no DHT, port mapping or local discovery
+LOOPBACK = {
+    'listen_interfaces': '127.0.0.1:0',
+    'enable_dht': False,
+    'enable_lsd': False,
+    'enable_upnp': False,
+    'enable_natpmp': False,
+    'allow_multiple_connections_per_ip': True
+}
+
+def make_payload(directory, size):
+    """Write `size` bytes of random data and build a torrent of it - returns the bencoded torrent"""
+    path = os.path.join(directory, 'payload.bin')
+    chunk = os.urandom(4 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(chunk[:size - written])
+            written += len(chunk)
+
+    fs = lt.file_storage()
+    lt.add_files(fs, path)
+    ct = lt.create_torrent(fs)
+    lt.set_piece_hashes(ct, directory)
+    return lt.bencode(ct.generate())
+
+def start_seeder(directory, torrent):
+    """Seed the payload from `directory` - returns (session, port)"""
+    settings = lt.high_performance_seed()
+    settings.update(LOOPBACK)
+    ses = lt.session(settings)
+
+    p = lt.add_torrent_params()
+    p.ti = lt.torrent_info(lt.bdecode(torrent))
+    p.save_path = directory
+    p.flags = lt.torrent_flags.seed_mode
+    ses.add_torrent(p)
+    return ses, ses.listen_port()
+
+def leech(profile, torrent, port, directory, timeout, results):
+    """Runs in a child process - download the payload from the seeder with one profile"""
+    ses = lt.session(session_settings(profile, **LOOPBACK))
+
+    p = lt.add_torrent_params()
+    p.ti = lt.torrent_info(lt.bdecode(torrent))
+    p.save_path = directory
+    p.storage_mode = storage_mode(profile)
+    handle = ses.add_torrent(p)
+    handle.connect_peer(('127.0.0.1', port))
+
+    start = time.monotonic()
+    first_byte = None
+    status = handle.status()
+    while not status.is_seeding:
+        if time.monotonic() - start > timeout:
+            results.put({'profile': profile, 'error': f"timed out at {status.progress * 100:.1f}%"})
+            return
+        time.sleep(0.05)
+        status = handle.status()
+        if first_byte is None and status.total_wanted_done:
+            first_byte = time.monotonic()
+
+    elapsed = time.monotonic() - (first_byte or start)
+    results.put({
+        'profile': profile,
+        'seconds': elapsed,
+        'rate': status.total_wanted / max(elapsed, 1e-6),
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux reports KB
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('profiles', nargs='*', help="Profiles to run (default: all)")
+    parser.add_argument('--size', type=int, default=512, help="Payload size in MB")
+    parser.add_argument('--timeout', type=int, default=600, help="Seconds allowed per profile")
+    parser.add_argument('--dir', default=None, help="Scratch directory (default: system temp)")
+    args = parser.parse_args()
+
+    profiles = args.profiles or list(Config.TORRENT_PROFILES)
+    for profile in profiles:
+        if profile not in Config.TORRENT_PROFILES:
+            parser.error(f"unknown profile: {profile}")
+
+    workdir = tempfile.mkdtemp(prefix='torrent-bench-', dir=args.dir)
+    try:
+        seed_dir = os.path.join(workdir, 'seed')
+        os.makedirs(seed_dir)
+        print(f"Creating {args.size} MB payload...")
+        torrent = make_payload(seed_dir, args.size * 1024 * 1024)
+        seeder, port = start_seeder(seed_dir, torrent)
+        print(f"Seeding on 127.0.0.1:{port}")
+
+        # Spawned children import libtorrent from scratch, so nothing leaks between profiles
+        context = multiprocessing.get_context('spawn')
+        rows = []
+        for profile in profiles:
+            leech_dir = os.path.join(workdir, profile)
+            os.makedirs(leech_dir)
+            results = context.Queue()
+            process = context.Process(target=leech, args=(profile, torrent, port, leech_dir, args.timeout, results))
+            process.start()
+            process.join(args.timeout + 30)
+            if process.is_alive():
+                process.kill()
+            try:
+                rows.append(results.get(timeout=5))
+            except queue.Empty:
+                rows.append({'profile': profile, 'error': f"exit code {process.exitcode}"})
+            shutil.rmtree(leech_dir, ignore_errors=True)
+            print(f"  {profile}: done")
+        del seeder
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(f"{'profile':<14}{'time':>10}{'throughput':>14}{'peak RSS':>12}")
+    for row in rows:
+        if 'error' in row:
+            print(f"{row['profile']:<14}  {row['error']}")
+        else:
+            print(
+                f"{row['profile']:<14}{row['seconds']:>9.1f}s"
+                f"{row['rate'] / 1024 / 1024:>9.1f} MB/s"
+                f"{row['peak_rss'] / 1024 / 1024:>9.0f} MB"
+            )
+    return 0 if all('error' not in row for row in rows) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
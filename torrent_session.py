@@ -0,0 +1,40 @@
+import libtorrent as lt
+from config import Config
+
+def _profile(name=None):
+    name = name or Config.TORRENT_PROFILE
+    if name not in Config.TORRENT_PROFILES:
+        raise ValueError(f"Unknown torrent profile: {name}")
+    return dict(Config.TORRENT_PROFILES[name])
+
+def session_settings(profile=None, **overrides):
+    """libtorrent settings for a Config.TORRENT_PROFILES entry - the bot's own settings on top, then `overrides`"""
+    settings = _profile(profile)
+    preset = settings.pop('preset', None)
+    settings.pop('storage_mode', None)
+
+    # Presets are libtorrent's own tuned starting points (min_memory_usage, high_performance_seed)
+    merged = getattr(lt, preset)() if preset else {}
+    merged.update({
+        'listen_interfaces': '0.0.0.0:6881',
+        'dht_bootstrap_nodes': 'router.bittorrent.com:6881,router.utorrent.com:6881',
+        'enable_dht': True,
+        'alert_mask': (
+            lt.alert.category_t.error_notification | lt.alert.category_t.storage_notification |
+            lt.alert.category_t.status_notification | lt.alert.category_t.file_progress_notification
+        )
+    })
+    merged.update(settings)
+    merged.update(overrides)
+
+    # Settings differ between libtorrent releases - drop the ones this build doesn't know
+    known = lt.default_settings()
+    for name in [name for name in merged if name not in known]:
+        print(f"Ignoring libtorrent setting unknown to this build: {name}")
+        del merged[name]
+    return merged
+
+def storage_mode(profile=None):
+    """storage_mode_t for a profile's 'storage_mode' - sparse or allocate"""
+    name = _profile(profile).get('storage_mode', 'sparse')
+    return getattr(lt.storage_mode_t, f"storage_mode_{name}")
@@ -0,0 +1,544 @@
+import os
+import time
+import types
+import asyncio
+import itertools
+import threading
+from config import Config
+from worker_process import WorkerProcess, connect
+
+# libtorrent itself is only ever imported inside the worker, so its threads,
+# caches and crashes stay there
+
+CALL_TIMEOUT = 60  # Seconds a command may take before the worker is considered stuck
+UPDATE_INTERVAL = 1  # Seconds between status updates of active torrents
+STATUS_FIELDS = (
+    'has_metadata', 'is_seeding', 'num_peers', 'num_incomplete',
+    'total_wanted', 'total_wanted_done', 'download_rate', 'progress'
+)
+
+class TorrentError(Exception):
+    """A torrent failed, or the torrent worker did"""
+
+def torrent_key(source):
+    """Hex infohash of add_torrent_params, a torrent_info or a torrent_handle - names its resume and metadata files"""
+    hashes = getattr(source, 'info_hashes', None)
+    if hashes is not None:
+        return str((hashes() if callable(hashes) else hashes).get_best())
+    info_hash = source.info_hash
+    return str(info_hash() if callable(info_hash) else info_hash)
+
+def _status(status):
+    return {field: getattr(status, field) for field in STATUS_FIELDS}
+
+class _Engine:
+    """Runs inside the worker process - the libtorrent session, its alert loop and the command handlers
+
+    Commands arrive on the pipe as (request_id, command, args) and are
+    answered with ('reply', request_id, result, error). The alert loop sends
+    ('status', key, fields), ('file', key, index) and ('finished', key, error)
+    events on its own, keyed by infohash.
+    """
+
+    def __init__(self, conn, resume_dir, metadata_dir, state_path):
+        import libtorrent as lt
+        from torrent_session import session_settings
+
+        self.lt = lt
+        self.conn = conn
+        self.resume_dir = resume_dir
+        self.metadata_dir = metadata_dir
+        self.state_path = state_path
+        self.handles = {}  # key -> torrent_handle
+        self.keys = {}  # torrent_handle -> key
+        self.running = True
+        self._send_lock = threading.Lock()
+        self._saving = set()  # Handles whose resume data shutdown is waiting for
+        self._saved = threading.Event()
+
+        # Restore the DHT routing table of the last run
+        params = lt.session_params()
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, 'rb') as f:
+                    params = lt.read_session_params(f.read())
+                print("Restored torrent session state")
+            except Exception as e:
+                print(f"Could not restore torrent session state: {e}")
+
+        self.session = lt.session(params)
+        self.session.apply_settings(session_settings())
+        print(f"Torrent session using the '{Config.TORRENT_PROFILE}' profile")
+
+    def send(self, msg):
+        with self._send_lock:
+            try:
+                self.conn.send(msg)
+            except OSError:
+                pass
+
+    def serve(self):
+        self.send(('ready', self.purge()))
+        threading.Thread(target=self._alerts, daemon=True).start()
+        while self.running:
+            try:
+                msg = self.conn.recv()
+            except EOFError:
+                break
+            if msg is None:
+                break
+            request_id, command, args = msg
+            try:
+                self.send(('reply', request_id, getattr(self, f"cmd_{command}")(*args), None))
+            except Exception as e:
+                self.send(('reply', request_id, None, str(e)))
+        self.running = False
+
+    def purge(self):
+        """Drop stale resume data and metadata - returns the save paths still resumable"""
+        cutoff = time.time() - Config.PARTIAL_MAX_AGE
+        resumable = []
+        for name in os.listdir(self.resume_dir):
+            path = os.path.join(self.resume_dir, name)
+            try:
+                if name.endswith('.resume') and os.path.getmtime(path) >= cutoff:
+                    with open(path, 'rb') as f:
+                        resumable.append(os.path.abspath(self.lt.read_resume_data(f.read()).save_path))
+                    continue
+            except Exception as e:
+                print(f"Dropping unreadable resume data {name}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        cutoff = time.time() - Config.TORRENT_METADATA_TTL
+        for name in os.listdir(self.metadata_dir):
+            path = os.path.join(self.metadata_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+        return resumable
+
+    def _resume_path(self, key):
+        return os.path.join(self.resume_dir, f"{key}.resume")
+
+    def _metadata_path(self, key):
+        return os.path.join(self.metadata_dir, f"{key}.torrent")
+
+    def _read_resume(self, key):
+        """add_torrent_params saved for an unfinished torrent, if its files are still on disk"""
+        path = self._resume_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                params = self.lt.read_resume_data(f.read())
+            if os.path.isdir(params.save_path):
+                return params
+        except Exception as e:
+            print(f"Could not read resume data for {key}: {e}")
+        os.remove(path)
+        return None
+
+    def _cache_metadata(self, key, info):
+        """Keep the metadata of a torrent so the next magnet for it starts downloading at once"""
+        path = self._metadata_path(key)
+        try:
+            if os.path.exists(path):
+                os.utime(path)
+                return
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.lt.bencode(self.lt.create_torrent(info).generate()))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Could not cache torrent metadata {key}: {e}")
+
+    def _save_resume(self, handles, only_if_modified=True):
+        flags = self.lt.save_resume_flags_t.save_info_dict
+        if only_if_modified:
+            flags |= self.lt.save_resume_flags_t.only_if_modified
+        for handle in handles:
+            handle.save_resume_data(flags)
+
+    def _write_resume(self, alert):
+        key = self.keys.get(alert.handle)
+        if key is None:
+            return  # Removed meanwhile - its resume file is gone for good
+        path = self._resume_path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.lt.write_resume_data_buf(alert.params))
+        os.replace(tmp_path, path)
+
+    def _alerts(self):
+        """Alert loop - status updates once per UPDATE_INTERVAL, resume data once per TORRENT_RESUME_INTERVAL"""
+        last_post = 0
+        last_resume = time.monotonic()
+        while self.running:
+            self.session.wait_for_alert(int(UPDATE_INTERVAL * 1000))
+
+            if self.handles and time.monotonic() - last_post >= UPDATE_INTERVAL:
+                self.session.post_torrent_updates()
+                last_post = time.monotonic()
+
+            if self.handles and time.monotonic() - last_resume >= Config.TORRENT_RESUME_INTERVAL:
+                self._save_resume([handle for handle in list(self.keys) if handle.is_valid()])
+                last_resume = time.monotonic()
+
+            for alert in self.session.pop_alerts():
+                try:
+                    self._dispatch(alert)
+                except Exception as e:
+                    print(f"Torrent alert error: {e}")
+
+    def _dispatch(self, alert):
+        lt = self.lt
+        if isinstance(alert, (lt.save_resume_data_alert, lt.save_resume_data_failed_alert)):
+            try:
+                if isinstance(alert, lt.save_resume_data_alert):
+                    self._write_resume(alert)
+            finally:
+                self._saving.discard(alert.handle)
+                if not self._saving:
+                    self._saved.set()
+            return
+
+        if isinstance(alert, lt.state_update_alert):
+            for status in alert.status:
+                key = self.keys.get(status.handle)
+                if key:
+                    self.send(('status', key, _status(status)))
+            return
+
+        key = self.keys.get(getattr(alert, 'handle', None))
+        if key is None:
+            return
+
+        if isinstance(alert, lt.file_completed_alert):
+            self.send(('file', key, alert.index))
+        elif isinstance(alert, lt.torrent_finished_alert):
+            self.send(('finished', key, None))
+        elif isinstance(alert, lt.metadata_failed_alert):
+            self.send(('finished', key, "Failed to fetch metadata (no peers/dead torrent)"))
+        elif isinstance(alert, (lt.torrent_error_alert, lt.file_error_alert)):
+            self.send(('finished', key, f"Torrent error: {alert.message()}"))
+        elif isinstance(alert, lt.metadata_received_alert):
+            self._cache_metadata(key, alert.handle.torrent_file())
+            self.send(('status', key, _status(alert.handle.status())))
+
+    def cmd_add(self, source, save_path):
+        """Add a magnet or .torrent with every file at priority 0 - from resume data or cached metadata when we have them"""
+        lt = self.lt
+        from torrent_session import storage_mode
+
+        if source.startswith('magnet:'):
+            p = lt.parse_magnet_uri(source)
+        else:
+            p = lt.add_torrent_params()
+            p.ti = lt.torrent_info(source)
+
+        key = torrent_key(p)
+        if key in self.handles:
+            # Already in the session for another request - the bot shares it
+            status = self.handles[key].status()
+            return {'key': key, 'save_path': status.save_path, 'resumed': False, 'existing': True, 'status': _status(status)}
+
+        # A torrent interrupted by a restart continues where it stopped,
+        # and a repeat magnet skips the metadata phase
+        resumed = self._read_resume(key)
+        if resumed:
+            p = resumed
+            print(f"Resuming torrent {key}")
+        else:
+            p.save_path = save_path
+            if not p.ti and os.path.exists(self._metadata_path(key)):
+                p.ti = lt.torrent_info(self._metadata_path(key))
+
+        p.storage_mode = storage_mode()
+        p.flags = lt.torrent_flags.auto_managed | lt.torrent_flags.default_dont_download
+
+        handle = self.session.add_torrent(p)
+        self.handles[key] = handle
+        self.keys[handle] = key
+        return {'key': key, 'save_path': p.save_path, 'resumed': bool(resumed), 'existing': False, 'status': _status(handle.status())}
+
+    def cmd_files(self, key):
+        info = self.handles[key].torrent_file()
+        self._cache_metadata(key, info)
+        files = info.files()
+        return {
+            'name': info.name(),
+            'total_size': info.total_size(),
+            'files': [(index, files.file_path(index), files.file_size(index)) for index in range(files.num_files())]
+        }
+
+    def cmd_prioritize(self, key, priorities):
+        self.handles[key].prioritize_files(priorities)
+
+    def cmd_file_progress(self, key):
+        return list(self.handles[key].file_progress())
+
+    def cmd_flush(self, key):
+        self.handles[key].flush_cache()
+
+    def cmd_remove(self, key):
+        handle = self.handles.pop(key, None)
+        if handle is None:
+            return
+        self.keys.pop(handle, None)
+        self.session.remove_torrent(handle)
+        try:
+            os.remove(self._resume_path(key))
+        except OSError:
+            pass
+
+    def cmd_shutdown(self, timeout):
+        """Save resume data of every torrent and the DHT state, then stop"""
+        handles = [handle for handle in list(self.keys) if handle.is_valid()]
+        self._saved.clear()
+        self._saving = set(handles)
+        self._save_resume(handles, only_if_modified=False)
+        if handles and not self._saved.wait(timeout):
+            print(f"Resume data missing for {len(self._saving)} torrent(s)")
+
+        self.session.pause()
+        try:
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.lt.write_session_params_buf(self.session.session_state()))
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"Could not save torrent session state: {e}")
+        self.running = False
+
+def _pin_resources():
+    """Runs inside the worker process - apply the Config.TORRENT_WORKER_* limits"""
+    try:
+        if Config.TORRENT_WORKER_NICE:
+            os.nice(Config.TORRENT_WORKER_NICE)
+        if Config.TORRENT_WORKER_CPUS:
+            os.sched_setaffinity(0, Config.TORRENT_WORKER_CPUS)
+        if Config.TORRENT_WORKER_MEMORY:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (Config.TORRENT_WORKER_MEMORY, Config.TORRENT_WORKER_MEMORY))
+    except (OSError, AttributeError, ValueError) as e:
+        print(f"Could not pin torrent worker resources: {e}")
+
+def _worker_main(conn, resume_dir, metadata_dir, state_path):
+    """Worker process entry point"""
+    _pin_resources()
+    _Engine(conn, resume_dir, metadata_dir, state_path).serve()
+
+class TorrentWatch:
+    """Latest status and outcome of one torrent, fed by the TorrentEngine's events"""
+
+    def __init__(self, key, status):
+        self.key = key
+        self.status = types.SimpleNamespace(**status)
+        self.error = None  # TorrentError that ended the torrent
+        self.completed_files = []  # File indices reported by file_completed alerts
+        self._changed = asyncio.Event()
+
+    def file_completed(self, index):
+        self.completed_files.append(index)
+        self._changed.set()
+
+    def update(self, status):
+        self.status = types.SimpleNamespace(**status)
+        self._changed.set()
+
+    def finish(self):
+        # libtorrent also reports this when every file is at priority 0, so it
+        # ends nothing - completion is read from the status and file events
+        self._changed.set()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self._changed.set()
+
+    def check(self):
+        """Raise the torrent's error, if it failed"""
+        if self.error:
+            raise self.error
+
+    async def changed(self, timeout):
+        """Wait for the next status update or the end of the torrent"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+class TorrentEngine:
+    """The bot's side of the torrent worker process
+
+    The worker owns the libtorrent session, so its memory, disk threads and
+    native crashes stay out of the bot's process. Commands are awaited with
+    `call()`; status events are routed to the TorrentWatch of their torrent.
+    A worker that dies fails every running torrent and is replaced on the
+    next command - periodically saved resume data lets re-added torrents
+    carry on.
+    """
+
+    def __init__(self, torrent_dir):
+        self.resume_dir = os.path.join(torrent_dir, '.resume')  # infohash.resume -> unfinished torrents
+        self.metadata_dir = os.path.join(torrent_dir, '.metadata')  # infohash.torrent -> fetched metadata
+        self.state_path = os.path.join(torrent_dir, '.session_state')
+        self.alive = False
+        self.conn = None
+        self.process = None
+        self._loop = None
+        self._ready = None
+        self._starting = None
+        self._ids = itertools.count(1)
+        self._calls = {}  # request id -> future
+        self._watches = {}  # key -> TorrentWatch
+        os.makedirs(self.resume_dir, exist_ok=True)
+        os.makedirs(self.metadata_dir, exist_ok=True)
+
+    async def start(self):
+        """Spawn the worker if it isn't running - returns the save paths of resumable torrents"""
+        if self.alive:
+            return []
+        if self._starting is None:
+            self._starting = asyncio.Lock()
+        async with self._starting:
+            if self.alive:
+                return []
+            self._loop = asyncio.get_running_loop()
+            self._ready = self._loop.create_future()
+            await self._loop.run_in_executor(None, self._spawn)
+            try:
+                return await asyncio.wait_for(self._ready, CALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.kill()
+                raise TorrentError("Torrent worker did not start")
+
+    def _spawn(self):
+        self.process = WorkerProcess(__file__, self.resume_dir, self.metadata_dir, self.state_path)
+        self.conn = self.process.conn
+        self.alive = True
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        """Hand every message of the worker to the event loop"""
+        conn = self.conn
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                msg = None
+            try:
+                if msg is None:
+                    self._loop.call_soon_threadsafe(self._crashed, conn)
+                    return
+                self._loop.call_soon_threadsafe(self._deliver, msg)
+            except RuntimeError:
+                return  # Event loop closed
+
+    def _deliver(self, msg):
+        kind = msg[0]
+        if kind == 'ready':
+            if self._ready and not self._ready.done():
+                self._ready.set_result(msg[1])
+        elif kind == 'reply':
+            future = self._calls.pop(msg[1], None)
+            if future and not future.done():
+                if msg[3]:
+                    future.set_exception(TorrentError(msg[3]))
+                else:
+                    future.set_result(msg[2])
+        else:
+            watch = self._watches.get(msg[1])
+            if watch is None:
+                return
+            if kind == 'status':
+                watch.update(msg[2])
+            elif kind == 'file':
+                watch.file_completed(msg[2])
+            elif kind == 'finished':
+                if msg[2]:
+                    watch.fail(TorrentError(msg[2]))
+                else:
+                    watch.finish()
+
+    def _crashed(self, conn):
+        if conn is not self.conn:
+            return  # An older worker we already replaced
+        if self.alive:
+            print("Torrent worker exited unexpectedly")
+        self.alive = False
+        error = TorrentError("Torrent engine crashed")
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(error)
+        self._calls.clear()
+        for watch in self._watches.values():
+            watch.fail(error)
+        if self._ready and not self._ready.done():
+            self._ready.set_exception(error)
+
+    async def call(self, command, *args, timeout=CALL_TIMEOUT):
+        """Run a command in the worker - returns its result or raises TorrentError"""
+        await self.start()
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._calls[request_id] = future
+        try:
+            self.conn.send((request_id, command, args))
+            return await asyncio.wait_for(future, timeout)
+        except OSError:
+            raise TorrentError("Torrent engine crashed")
+        except asyncio.TimeoutError:
+            raise TorrentError(f"Torrent engine did not answer '{command}'")
+        finally:
+            self._calls.pop(request_id, None)
+
+    def post(self, command, *args):
+        """Send a command without waiting for its reply"""
+        if not self.alive:
+            return
+        try:
+            self.conn.send((next(self._ids), command, args))
+        except OSError:
+            pass
+
+    def watch(self, key, status):
+        watch = TorrentWatch(key, status)
+        self._watches[key] = watch
+        return watch
+
+    def unwatch(self, key):
+        self._watches.pop(key, None)
+
+    async def stop(self, timeout=30):
+        """Save every torrent's resume data and the session state, then stop the worker"""
+        if not self.alive:
+            return
+        try:
+            await self.call('shutdown', timeout / 2, timeout=timeout)
+        except TorrentError as e:
+            print(f"Torrent worker shutdown: {e}")
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        await self._loop.run_in_executor(None, self.process.join, 5)
+        self.kill()
+
+    def kill(self):
+        self.alive = False
+        if self.process and self.process.is_alive():
+            self.process.kill()
+        if self.conn:
+            self.conn.close()
+
+if __name__ == '__main__':
+    # Started by TorrentEngine._spawn()
+    conn, args = connect()
+    _worker_main(conn, *args)
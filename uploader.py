@@ -0,0 +1,277 @@
+import os
+import math
+import asyncio
+from pyrogram import raw, types, utils
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from config import Config
+from helpers import merge_range, range_covered, get_mime_type
+
+PART_SIZE = 512 * 1024  # Largest part size Telegram accepts
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Files above this size must use SaveBigFilePart
+
+_media_sessions = {}  # client -> MediaSessions
+
+class MediaSessions:
+    """Extra MTProto connections to the account's DC that carry file parts
+
+    Pyrogram uploads every part over a single media connection. Spreading
+    parts round-robin over several connections keeps more of them in flight
+    at once, which is what large uploads are bound by.
+    """
+
+    def __init__(self, client, size):
+        self.client = client
+        self.size = size
+        self.sessions = []
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            while len(self.sessions) < self.size:
+                session = Session(
+                    self.client, await self.client.storage.dc_id(), await self.client.storage.auth_key(),
+                    await self.client.storage.test_mode(), is_media=True
+                )
+                await session.start()
+                self.sessions.append(session)
+
+    def next(self):
+        session = self.sessions[self._next % len(self.sessions)]
+        self._next += 1
+        return session
+
+    async def stop(self):
+        for session in self.sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                print(f"Media session stop error: {e}")
+        self.sessions = []
+
+async def media_sessions(client):
+    """The started MediaSessions pool of a client, shared by all of its uploads"""
+    pool = _media_sessions.get(client)
+    if pool is None:
+        pool = _media_sessions[client] = MediaSessions(client, Config.UPLOAD_CONNECTIONS)
+    await pool.start()
+    return pool
+
+async def stop_media_sessions():
+    """Close every upload connection - call on shutdown"""
+    for pool in _media_sessions.values():
+        await pool.stop()
+    _media_sessions.clear()
+
+class PartUploader:
+    """Uploads one file to Telegram part by part with raw MTProto calls"""
+
+    def __init__(self, client, file_size, file_name, sessions=None):
+        self.client = client
+        self.file_size = file_size
+        self.file_name = file_name
+        self.file_id = client.rnd_id()
+        self.total_parts = max(1, math.ceil(file_size / PART_SIZE))
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.sessions = sessions  # MediaSessions - parts go over the client's main connection without one
+
+    async def save_part(self, index, data, retries=3):
+        """Upload a single part, retrying transient errors and waiting out flood limits"""
+        if self.is_big:
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id,
+                file_part=index,
+                file_total_parts=self.total_parts,
+                bytes=data
+            )
+        else:
+            rpc = raw.functions.upload.SaveFilePart(
+                file_id=self.file_id,
+                file_part=index,
+                bytes=data
+            )
+
+        attempt = 0
+        while True:
+            try:
+                invoke = self.sessions.next().invoke if self.sessions else self.client.invoke
+                if not await invoke(rpc):
+                    raise IOError(f"Telegram rejected part {index}")
+                return
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                await asyncio.sleep(attempt)
+
+    def input_file(self):
+        """Reference to the uploaded parts for use in SendMedia"""
+        if self.is_big:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=self.file_name)
+        return raw.types.InputFile(id=self.file_id, parts=self.total_parts, name=self.file_name, md5_checksum="")
+
+async def upload_file(client, path, progress=None, workers=Config.UPLOAD_WORKERS):
+    """Upload a file's parts concurrently over the media connections - returns the InputFile for SendMedia
+
+    `progress(current, total, "Uploading")` is awaited after every part, one
+    call at a time, so a throttle_progress() wrapper paces the whole upload.
+    """
+    file_size = os.path.getsize(path)
+    uploader = PartUploader(client, file_size, os.path.basename(path), await media_sessions(client))
+    parts = iter(range(uploader.total_parts))
+    loop = asyncio.get_running_loop()
+    report_lock = asyncio.Lock()
+    uploaded = 0
+    fd = os.open(path, os.O_RDONLY)
+
+    async def worker():
+        nonlocal uploaded
+        # One buffer per worker, refilled only once Telegram acknowledged the
+        # part it held - no per-part allocations for multi-GB files
+        buffer = bytearray(PART_SIZE)
+        view = memoryview(buffer)
+        for index in parts:
+            length = await loop.run_in_executor(None, os.preadv, fd, [buffer], index * PART_SIZE)
+            await uploader.save_part(index, view[:length])
+            if progress:
+                async with report_lock:
+                    uploaded += length
+                    await progress(uploaded, file_size, "Uploading")
+
+    tasks = [asyncio.create_task(worker()) for _ in range(min(workers, uploader.total_parts))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        os.close(fd)
+    return uploader.input_file()
+
+async def send_uploaded_document(client, chat_id, input_file, file_name, caption="", thumb=None, video=None):
+    """Send already uploaded parts as a document - or a streamable video given (duration, width, height) - and return the resulting Message"""
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if video:
+        duration, width, height = video
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            duration=duration, w=width, h=height, supports_streaming=True
+        ))
+
+    media = raw.types.InputMediaUploadedDocument(
+        file=input_file,
+        mime_type=get_mime_type(file_name),
+        thumb=await client.save_file(thumb) if thumb else None,
+        attributes=attributes
+    )
+
+    r = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=media,
+            random_id=client.rnd_id(),
+            **await utils.parse_text_entities(client, caption, None, None)
+        )
+    )
+
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+
+class StreamingUpload:
+    """Uploads a file to Telegram while it is still being downloaded
+
+    The downloader reports byte ranges as they reach disk. Every part that is
+    fully covered is read back from the page cache and sent right away by a
+    small pool of workers, so only `workers` parts are ever held in memory
+    and the upload ends shortly after the download does. Each part is paced
+    as an upload of `user_id` by the `bandwidth` scheduler, if given.
+    """
+
+    def __init__(self, client, bandwidth=None, user_id=None, workers=Config.STREAM_UPLOAD_WORKERS):
+        self.client = client
+        self.bandwidth = bandwidth
+        self.user_id = user_id
+        self.workers = workers
+        self.started = False
+        self.uploader = None
+        self._fd = None
+        self._queue = None
+        self._tasks = []
+        self._covered = []
+        self._queued = set()
+
+    def start(self, path, file_size, file_name):
+        """Called by the downloader once the target file exists and its size is known"""
+        if self.started or not file_size:
+            return
+
+        # Keep our own descriptor so the final rename of the .part file doesn't matter
+        self._fd = os.open(path, os.O_RDONLY)
+        self.uploader = PartUploader(self.client, file_size, file_name)
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.started = True
+
+    def written(self, start, end):
+        """Called by the downloader when bytes [start, end) are on disk"""
+        if not self.started:
+            return
+
+        self._covered = merge_range(self._covered, start, end)
+
+        for index in range(start // PART_SIZE, (end - 1) // PART_SIZE + 1):
+            if index in self._queued:
+                continue
+            part_start = index * PART_SIZE
+            part_end = min(part_start + PART_SIZE, self.uploader.file_size)
+            if range_covered(self._covered, part_start, part_end):
+                self._queued.add(index)
+                self._queue.put_nowait(index)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            index = await self._queue.get()
+            if index is None:
+                return
+            if self.uploader.sessions is None:
+                self.uploader.sessions = await media_sessions(self.client)
+            offset = index * PART_SIZE
+            length = min(PART_SIZE, self.uploader.file_size - offset)
+            if self.bandwidth:
+                await self.bandwidth.acquire(length, self.user_id, 'upload')
+            data = await loop.run_in_executor(None, os.pread, self._fd, length, offset)
+            await self.uploader.save_part(index, data)
+
+    async def send(self, chat_id, file_name, caption="", thumb=None):
+        """Wait for the remaining parts, then send the file as a document"""
+        for _ in self._tasks:
+            self._queue.put_nowait(None)
+
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            self.abort()
+
+        if len(self._queued) != self.uploader.total_parts:
+            raise IOError("Download finished with parts missing from the upload")
+
+        return await send_uploaded_document(
+            self.client, chat_id, self.uploader.input_file(), file_name, caption, thumb
+        )
+
+    def abort(self):
+        """Stop the workers and release the file"""
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,53 @@
+"""Worker processes started from their own script
+
+multiprocessing's spawn and forkserver children re-import the parent's main
+module, which for the bot means bot.py - its client, handlers and config.
+Workers are started as `python <worker script> <fd> ...` instead, so the
+worker script is their __main__, and talk to the bot over a
+multiprocessing Connection on a socket pair.
+"""
+import os
+import sys
+import socket
+import subprocess
+from multiprocessing.connection import Connection
+
+class WorkerProcess:
+    """A worker script run by the bot's interpreter - the subset of multiprocessing.Process the engines use"""
+
+    def __init__(self, script, *args):
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            # The worker keeps the bot's working directory, so relative Config paths still resolve
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(script), str(child_sock.fileno()), *map(str, args)],
+                pass_fds=[child_sock.fileno()]
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+        self.pid = self.process.pid
+
+    @property
+    def exitcode(self):
+        return self.process.poll()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def join(self, timeout=None):
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def kill(self):
+        self.process.kill()
+        self.join(5)  # Reap it
+
+def connect():
+    """Runs inside the worker process - its end of the pipe, plus the remaining arguments"""
+    return Connection(int(sys.argv[1])), sys.argv[2:]
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from config import Config
+from helpers import format_time, hash_file, url_host
+from worker_process import WorkerProcess, connect
+
+_engines = {}  # Worker process only: option profile -> warmed YoutubeDL
+_extractors = None  # Worker process only: yt-dlp extractor classes other than the generic one
+_host_extractors = {}  # Worker process only: host -> extractor classes that matched a URL on it
+
+GRANT_SIZE = 256 * 1024  # Bytes a worker downloads before asking the bot for more bandwidth
+REPORT_INTERVAL = 1  # Seconds between progress updates shown to the user
+MATCH_TIMEOUT = 60  # Seconds an extractor match may take
+PROBE_TIMEOUT = 2 * 60  # Seconds a probe or warm-up may hold a pool slot - downloads get Config.YTDLP_TIMEOUT
+FORMAT_FIELDS = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'tbr', 'abr', 'filesize', 'filesize_approx')
+
+def _describe(info):
+    """The part of an extract_info() result the bot needs - small enough to cache and send over a pipe"""
+    if info.get('_type') in ('playlist', 'multi_video'):
+        entries = [entry for entry in info.get('entries') or [] if entry]
+        return {
+            'title': info.get('title', 'Playlist'),
+            'playlist': True,
+            'count': info.get('playlist_count') or len(entries),
+            'entries': [
+                {
+                    'title': entry.get('title') or f"Item {index}",
+                    # Flat entries point at their own page; fully extracted ones are fetched by index
+                    'url': entry.get('url') if entry.get('_type') in ('url', 'url_transparent') else None
+                }
+                for index, entry in enumerate(entries, start=1)
+            ]
+        }
+    
+    return {
+        'title': info.get('title', 'Video'),
+        'duration': info.get('duration'),
+        'extractor': info.get('extractor'),
+        'formats': [
+            {key: f.get(key) for key in FORMAT_FIELDS}
+            for f in info.get('formats') or []
+        ]
+    }
+
+def _engine(opts):
+    """Runs inside the worker process - the YoutubeDL for an option profile, built once and reused"""
+    import yt_dlp
+
+    key = json.dumps(opts, sort_keys=True, default=str)
+    ydl = _engines.get(key)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(opts)
+        # Resolve the extractor list now rather than on the first URL
+        list(yt_dlp.extractor.gen_extractor_classes())
+        _engines[key] = ydl
+    return ydl
+
+def _warm(opts):
+    """Runs inside the worker process - build the engine for a profile ahead of the first job"""
+    start = time.monotonic()
+    try:
+        _engine(opts)
+    except Exception as e:
+        return ('error', f"Warm-up error: {str(e)}")
+    return ('warmed', time.monotonic() - start)
+
+def _match(url):
+    """Runs inside the worker process - keys of the extractors (other than the generic one) whose suitable() accepts url
+
+    Extractors that matched before on the same host are tried first.
+    """
+    global _extractors
+    import yt_dlp
+
+    host = url_host(url)
+    known = _host_extractors.get(host, ())
+    matches = [ie for ie in known if ie.suitable(url)]
+    if not matches:
+        if _extractors is None:
+            _extractors = [ie for ie in yt_dlp.extractor.gen_extractor_classes() if ie.ie_key() != 'Generic']
+        matches = [ie for ie in _extractors if ie.suitable(url)]
+        if matches:
+            _host_extractors[host] = tuple(dict.fromkeys(list(known) + matches))
+    return ('matched', [ie.ie_key() for ie in matches])
+
+def _probe(url, opts):
+    """Runs inside the worker process - extract metadata without downloading"""
+    import yt_dlp
+
+    try:
+        return ('info', _describe(_engine(opts).extract_info(url, download=False)))
+    except yt_dlp.utils.DownloadError as e:
+        return ('error', f"yt-dlp error: {str(e)}")
+    except Exception as e:
+        return ('error', f"Extraction error: {str(e)}")
+
+def _run_job(conn, lock, url, opts):
+    """Runs inside the worker process - download one URL and describe the result"""
+    import yt_dlp
+
+    received = {}
+    totals = {}
+    state = {'pending': 0, 'last_sent': 0}
+
+    # yt-dlp calls hooks from its fragment threads, hundreds of times a second
+    # for fragmented formats, so most calls only update counters. Every
+    # GRANT_SIZE bytes (or REPORT_INTERVAL seconds) the hook reports to the
+    # bot and blocks until its bandwidth scheduler lets it continue, which
+    # paces the transfer itself.
+    def throttle(d):
+        if d.get('status') != 'downloading':
+            return
+        with lock:
+            name = d.get('filename')
+            done = d.get('downloaded_bytes') or 0
+            state['pending'] += max(0, done - received.get(name, 0))
+            received[name] = done
+            totals[name] = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+
+            now = time.monotonic()
+            if state['pending'] < GRANT_SIZE and now - state['last_sent'] < REPORT_INTERVAL:
+                return
+            conn.send(('bytes', state['pending'], sum(received.values()), int(sum(totals.values()))))
+            state['pending'] = 0
+            state['last_sent'] = now
+            conn.recv()
+
+    opts = dict(opts, progress_hooks=[throttle])
+
+    try:
+        # Output paths, format and hooks differ per job, and YoutubeDL compiles
+        # its format selector and output template when it is built, so downloads
+        # get their own instance - cheap once the process has loaded the extractors
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+            if info.get('entries'):
+                # A single playlist item selected with playlist_items
+                info = next(entry for entry in info['entries'] if entry)
+            filename = ydl.prepare_filename(info)
+
+            base = os.path.splitext(filename)[0]
+            possible_files = [f"{base}.mp4", f"{base}.mkv", f"{base}.webm", filename]
+
+            filename = next((pfile for pfile in possible_files if os.path.exists(pfile)), filename)
+            # yt-dlp and ffmpeg write the file themselves, so it is hashed here while still in the page cache
+            digest = hash_file(filename, Config.HASH_BLOCK_SIZE) if os.path.exists(filename) else None
+            return ('done', filename, info.get('title', 'Video'), digest)
+    except yt_dlp.utils.DownloadError as e:
+        return ('error', f"yt-dlp download error: {str(e)}")
+    except Exception as e:
+        return ('error', f"Download error: {str(e)}")
+
+def _worker_main(conn):
+    """Worker process loop - run jobs until the pipe closes"""
+    lock = threading.Lock()
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg is None:
+            return
+        kind, url, opts = msg
+        if kind == 'warm':
+            conn.send(_warm(opts))
+        elif kind == 'probe':
+            conn.send(_probe(url, opts))
+        elif kind == 'match':
+            conn.send(_match(url))
+        else:
+            conn.send(_run_job(conn, lock, url, opts))
+
+class YtdlpWorker:
+    """One long-lived yt-dlp process plus the thread that answers it"""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.alive = False
+        self.conn = None
+        self.process = None
+        self._loop = None
+        self._future = None
+        self._user_id = None
+        self.latest = None  # (downloaded, total) - written by the reader thread, latest value wins
+
+    def start(self):
+        """Spawn the process - blocking, run it in an executor"""
+        self.process = WorkerProcess(__file__)
+        self.conn = self.process.conn
+        self.alive = True
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        """Answer bandwidth requests and hand results back to the event loop"""
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                self.alive = False
+                self._resolve((None, "yt-dlp worker crashed"))
+                return
+
+            if msg[0] == 'bytes':
+                self.latest = (msg[2], msg[3])
+                self.bandwidth.acquire_sync(msg[1], self._user_id)
+                try:
+                    self.conn.send(('ok',))
+                except OSError:
+                    pass
+            elif msg[0] == 'done':
+                self._resolve(((msg[1], msg[2], msg[3]), None))
+            elif msg[0] in ('info', 'warmed', 'matched'):
+                self._resolve((msg[1], None))
+            else:
+                self._resolve((None, msg[1]))
+
+    def _resolve(self, result):
+        future = self._future
+        if future is None:
+            return
+
+        def deliver():
+            if not future.done():
+                future.set_result(result)
+
+        self._loop.call_soon_threadsafe(deliver)
+
+    async def _report(self, progress_callback):
+        """Forward the newest progress snapshot to the user once per REPORT_INTERVAL"""
+        start_time = time.time()
+        shown = None
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            latest = self.latest
+            if latest is None or latest == shown:
+                continue
+            shown = latest
+            speed = latest[0] / max(time.time() - start_time, 1) / (1024 * 1024)
+            try:
+                await progress_callback(latest[0], latest[1], f"Downloading ({speed:.1f} MB/s)")
+            except Exception as e:
+                print(f"Progress callback error: {e}")
+
+    async def run(self, kind, url, opts, user_id, timeout, progress_callback=None):
+        """Run one job; returns (result, None) or (None, error)"""
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+        self._user_id = user_id
+        self.latest = None
+        reporter = asyncio.create_task(self._report(progress_callback)) if progress_callback else None
+
+        try:
+            self.conn.send((kind, url, opts))
+            return await asyncio.wait_for(self._future, timeout)
+        except asyncio.TimeoutError:
+            self.kill()
+            return None, f"yt-dlp timed out after {format_time(timeout)}"
+        except BaseException:
+            # Cancelled - the process would keep downloading, so stop it
+            self.kill()
+            raise
+        finally:
+            self._future = None
+            if reporter:
+                reporter.cancel()
+
+    def kill(self):
+        self.alive = False
+        if self.process and self.process.is_alive():
+            self.process.kill()
+        if self.conn:
+            self.conn.close()
+
+    def close(self):
+        """Ask an idle worker to exit"""
+        if self.alive:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.alive = False
+
+class YtdlpPool:
+    """Bounded pool of yt-dlp worker processes
+
+    Extraction and fragment handling are GIL-heavy, so they run outside the
+    bot's process. At most `size` jobs run at once - the rest wait their turn -
+    and a download that hangs past `timeout`, a probe or warm-up that hangs
+    past PROBE_TIMEOUT, or a crash takes down only its own worker, which is
+    replaced on demand. Extractor matches run on a worker of their own, so
+    routing a link never waits behind running downloads.
+    """
+
+    def __init__(self, size, timeout, bandwidth):
+        self.size = size
+        self.timeout = timeout
+        self.bandwidth = bandwidth
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+        self._workers = set()
+        self._matcher = None
+        self._matching = asyncio.Lock()
+
+    async def run(self, url, opts, user_id=None, progress_callback=None):
+        """Queue a download - returns ((filepath, title, content hash), None) or (None, error)"""
+        return await self._submit('run', url, opts, user_id, progress_callback)
+
+    async def probe(self, url, opts):
+        """Queue a metadata extraction - returns (info, None) or (None, error)"""
+        return await self._submit('probe', url, opts)
+
+    async def match(self, url):
+        """Keys of the yt-dlp extractors that accept url - returns (keys, None) or (None, error)"""
+        async with self._matching:
+            if self._matcher is None or not self._matcher.alive:
+                self._matcher = YtdlpWorker(self.bandwidth)
+                await asyncio.get_running_loop().run_in_executor(None, self._matcher.start)
+            return await self._matcher.run('match', url, None, None, MATCH_TIMEOUT)
+
+    async def warm(self, opts):
+        """Start every worker and build its engine for `opts` before the first job arrives"""
+        start = time.monotonic()
+        results = await asyncio.gather(*[self._submit('warm', None, opts) for _ in range(self.size)])
+        ready = sum(1 for _, error in results if error is None)
+        print(f"yt-dlp pool warmed: {ready}/{self.size} workers in {time.monotonic() - start:.2f}s")
+
+    async def _submit(self, kind, url, opts, user_id=None, progress_callback=None):
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker.alive:
+                worker = YtdlpWorker(self.bandwidth)
+                await asyncio.get_running_loop().run_in_executor(None, worker.start)
+                self._workers.add(worker)
+
+            try:
+                timeout = self.timeout if kind == 'run' else PROBE_TIMEOUT
+                return await worker.run(kind, url, opts, user_id, timeout, progress_callback)
+            finally:
+                if worker.alive:
+                    self._idle.append(worker)
+                else:
+                    self._workers.discard(worker)
+
+    def shutdown(self):
+        """Stop all workers"""
+        for worker in self._workers:
+            if worker in self._idle:
+                worker.close()
+            else:
+                worker.kill()
+        self._workers.clear()
+        self._idle.clear()
+        if self._matcher:
+            if self._matching.locked():
+                self._matcher.kill()
+            else:
+                self._matcher.close()
+            self._matcher = None
+
+if __name__ == '__main__':
+    # Started by YtdlpWorker.start() - load yt-dlp and its extractors before the first job
+    import yt_dlp.extractor.extractors
+    conn, _ = connect()
+    _worker_main(conn)